@@ -1,3 +1,4 @@
 from .agent_cmd import *
 from .agent_baselines import *
-from .agent_dqn import *
\ No newline at end of file
+from .agent_dqn import *
+from .state_featurizer import *
\ No newline at end of file
@@ -21,11 +21,17 @@ import numpy as np
 from deep_dialog import dialog_config
 
 from agent import Agent
-from deep_dialog.qlearning import DQN
+from state_featurizer import StateFeaturizer, IncrementalStateEncoder
+from deep_dialog.qlearning import DQN, ReplayBuffer
+from deep_dialog.model_file import load_model_file
 
 
 
 class AgentDQN(Agent):
+    
+    # attributes that belong to the dialog being played rather than to the agent (see BatchedDialogManager)
+    episode_attributes = ['current_slot_id', 'phase', 'request_set', 'representation', 'representation_state', 'action']
+    
     def __init__(self, movie_dict=None, act_set=None, slot_set=None, params=None):
         self.movie_dict = movie_dict
         self.act_set = act_set
@@ -39,9 +45,8 @@ class AgentDQN(Agent):
         self.epsilon = params['epsilon']
         self.agent_run_mode = params['agent_run_mode']
         self.agent_act_level = params['agent_act_level']
-        self.experience_replay_pool = [] #experience replay pool <s_t, a_t, r_t, s_t+1>
-        
         self.experience_replay_pool_size = params.get('experience_replay_pool_size', 1000)
+        self.experience_replay_pool_max_size = params.get('experience_replay_pool_max_size', None)
         self.hidden_size = params.get('dqn_hidden_size', 60)
         self.gamma = params.get('gamma', 0.9)
         self.predict_mode = params.get('predict_mode', False)
@@ -49,6 +54,11 @@ class AgentDQN(Agent):
         
         self.max_turn = params['max_turn'] + 4
         self.state_dimension = 2 * self.act_cardinality + 7 * self.slot_cardinality + 3 + self.max_turn
+        self.featurizer = StateFeaturizer(act_set, slot_set, self.max_turn)
+        self.next_representation = self.featurizer.new_row() # scratch row of s_t+1, copied by the replay pool
+        self.representation_state = None # the state self.representation encodes
+        
+        self.experience_replay_pool = ReplayBuffer(self.state_dimension, self.experience_replay_pool_size, self.experience_replay_pool_max_size) #experience replay pool <s_t, a_t, r_t, s_t+1>
         
         self.dqn = DQN(self.state_dimension, self.hidden_size, self.num_actions)
         self.clone_dqn = copy.deepcopy(self.dqn)
@@ -57,7 +67,7 @@ class AgentDQN(Agent):
                 
         # Prediction Mode: load trained DQN model
         if params['trained_model_path'] != None:
-            self.dqn.model = copy.deepcopy(self.load_trained_DQN(params['trained_model_path']))
+            self.dqn.set_model(self.load_trained_DQN(params['trained_model_path']))
             self.clone_dqn = copy.deepcopy(self.dqn)
             self.predict_mode = True
             self.warm_start = 2
@@ -75,99 +85,77 @@ class AgentDQN(Agent):
         """ DQN: Input state, output action """
         
         self.representation = self.prepare_state_representation(state)
+        self.representation_state = state
         self.action = self.run_policy(self.representation)
         act_slot_response = copy.deepcopy(self.feasible_actions[self.action])
         return {'act_slot_response': act_slot_response, 'act_slot_value_response': None}
+    
+    def state_to_action_batch(self, states, episode_contexts):
+        """ DQN: Input the states of several concurrent dialogs, output one action per dialog
+
+        The greedy decisions of all the dialogs are taken with a single DQN forward pass.
+        episode_contexts holds the episode_context() of each dialog and is updated in place.
+        """
+        
+        representations = []
+        actions = []
+        for i, state in enumerate(states):
+            self.set_episode_context(episode_contexts[i])
+            representations.append(self.prepare_state_representation(state))
+            actions.append(self.run_exploration_policy())
+            episode_contexts[i] = self.episode_context()
+        
+        greedy = [i for i, action in enumerate(actions) if action is None]
+        if len(greedy) > 0:
+            greedy_actions = self.dqn.predict_batch(np.vstack([representations[i] for i in greedy]), {})
+            for i, action in zip(greedy, greedy_actions):
+                actions[i] = int(action)
         
+        agent_actions = []
+        for i, action in enumerate(actions):
+            episode_contexts[i]['representation'] = representations[i]
+            episode_contexts[i]['representation_state'] = states[i]
+            episode_contexts[i]['action'] = action
+            agent_actions.append({'act_slot_response': copy.deepcopy(self.feasible_actions[action]), 'act_slot_value_response': None})
+        return agent_actions
     
-    def prepare_state_representation(self, state):
-        """ Create the representation for each state """
+    def episode_context(self):
+        """ The per-dialog attributes of the agent """
         
-        user_action = state['user_action']
-        current_slots = state['current_slots']
-        kb_results_dict = state['kb_results_dict']
-        agent_last = state['agent_action']
+        return dict((name, getattr(self, name, None)) for name in self.episode_attributes)
+    
+    def set_episode_context(self, episode_context):
+        """ Restore the per-dialog attributes saved by episode_context() """
         
-        ########################################################################
-        #   Create one-hot of acts to represent the current user action
-        ########################################################################
-        user_act_rep =  np.zeros((1, self.act_cardinality))
-        user_act_rep[0,self.act_set[user_action['diaact']]] = 1.0
-
-        ########################################################################
-        #     Create bag of inform slots representation to represent the current user action
-        ########################################################################
-        user_inform_slots_rep = np.zeros((1, self.slot_cardinality))
-        for slot in user_action['inform_slots'].keys():
-            user_inform_slots_rep[0,self.slot_set[slot]] = 1.0
-
-        ########################################################################
-        #   Create bag of request slots representation to represent the current user action
-        ########################################################################
-        user_request_slots_rep = np.zeros((1, self.slot_cardinality))
-        for slot in user_action['request_slots'].keys():
-            user_request_slots_rep[0, self.slot_set[slot]] = 1.0
-
-        ########################################################################
-        #   Creat bag of filled_in slots based on the current_slots
-        ########################################################################
-        current_slots_rep = np.zeros((1, self.slot_cardinality))
-        for slot in current_slots['inform_slots']:
-            current_slots_rep[0, self.slot_set[slot]] = 1.0
-
-        ########################################################################
-        #   Encode last agent act
-        ########################################################################
-        agent_act_rep = np.zeros((1,self.act_cardinality))
-        if agent_last:
-            agent_act_rep[0, self.act_set[agent_last['diaact']]] = 1.0
-
-        ########################################################################
-        #   Encode last agent inform slots
-        ########################################################################
-        agent_inform_slots_rep = np.zeros((1, self.slot_cardinality))
-        if agent_last:
-            for slot in agent_last['inform_slots'].keys():
-                agent_inform_slots_rep[0,self.slot_set[slot]] = 1.0
-
-        ########################################################################
-        #   Encode last agent request slots
-        ########################################################################
-        agent_request_slots_rep = np.zeros((1, self.slot_cardinality))
-        if agent_last:
-            for slot in agent_last['request_slots'].keys():
-                agent_request_slots_rep[0,self.slot_set[slot]] = 1.0
+        for name, value in episode_context.items():
+            setattr(self, name, value)
         
-        turn_rep = np.zeros((1,1)) + state['turn'] / 10.
-
-        ########################################################################
-        #  One-hot representation of the turn count?
-        ########################################################################
-        turn_onehot_rep = np.zeros((1, self.max_turn))
-        turn_onehot_rep[0, state['turn']] = 1.0
-
-        ########################################################################
-        #   Representation of KB results (scaled counts)
-        ########################################################################
-        kb_count_rep = np.zeros((1, self.slot_cardinality + 1)) + kb_results_dict['matching_all_constraints'] / 100.
-        for slot in kb_results_dict:
-            if slot in self.slot_set:
-                kb_count_rep[0, self.slot_set[slot]] = kb_results_dict[slot] / 100.
-
-        ########################################################################
-        #   Representation of KB results (binary)
-        ########################################################################
-        kb_binary_rep = np.zeros((1, self.slot_cardinality + 1)) + np.sum( kb_results_dict['matching_all_constraints'] > 0.)
-        for slot in kb_results_dict:
-            if slot in self.slot_set:
-                kb_binary_rep[0, self.slot_set[slot]] = np.sum( kb_results_dict[slot] > 0.)
-
-        self.final_representation = np.hstack([user_act_rep, user_inform_slots_rep, user_request_slots_rep, agent_act_rep, agent_inform_slots_rep, agent_request_slots_rep, current_slots_rep, turn_rep, turn_onehot_rep, kb_binary_rep, kb_count_rep])
+    
+    def new_state_encoder(self):
+        """ An encoder maintaining the representation of one dialog's state as its state tracker records the actions """
+        
+        return IncrementalStateEncoder(self.featurizer)
+    
+    def prepare_state_representation(self, state):
+        """ Create the representation for each state (read-only when the state tracker has encoded it already) """
+        
+        representation = state.get('representation')
+        if representation is None or representation.shape != (1, self.state_dimension):
+            representation = self.featurizer.featurize(state)
+        self.final_representation = representation
         return self.final_representation
       
     def run_policy(self, representation):
         """ epsilon-greedy policy """
         
+        action = self.run_exploration_policy()
+        if action is None:
+            action = self.dqn.predict(representation, {}, predict_model=True)
+        return action
+    
+    def run_exploration_policy(self):
+        """ The non-greedy part of the epsilon-greedy policy: a random or rule action, None to act greedily with the DQN """
+        
         if random.random() < self.epsilon:
             return random.randint(0, self.num_actions - 1)
         else:
@@ -176,7 +164,7 @@ class AgentDQN(Agent):
                     self.warm_start = 2
                 return self.rule_policy()
             else:
-                return self.dqn.predict(representation, {}, predict_model=True)
+                return None
     
     def rule_policy(self):
         """ Rule Policy """
@@ -211,17 +199,25 @@ class AgentDQN(Agent):
     def register_experience_replay_tuple(self, s_t, a_t, reward, s_tplus1, episode_over):
         """ Register feedback from the environment, to be stored as future training data """
         
-        state_t_rep = self.prepare_state_representation(s_t)
+        if self.predict_mode == False and self.warm_start != 1: # Training Mode, past the warm start: nothing is stored
+            return
+        
+        if s_t is self.representation_state: # encoded when the action was taken
+            state_t_rep = self.representation
+        else:
+            state_t_rep = self.prepare_state_representation(s_t)
         action_t = self.action
         reward_t = reward
-        state_tplus1_rep = self.prepare_state_representation(s_tplus1)
-        training_example = (state_t_rep, action_t, reward_t, state_tplus1_rep, episode_over)
+        state_tplus1_rep = s_tplus1.get('representation')
+        if state_tplus1_rep is None or state_tplus1_rep.shape != (1, self.state_dimension):
+            state_tplus1_rep = self.featurizer.featurize(s_tplus1, self.next_representation)
         
-        if self.predict_mode == False: # Training Mode
-            if self.warm_start == 1:
-                self.experience_replay_pool.append(training_example)
-        else: # Prediction Mode
-            self.experience_replay_pool.append(training_example)
+        self.experience_replay_pool.append(state_t_rep, action_t, reward_t, state_tplus1_rep, episode_over)
+    
+    def update_clone_dqn(self):
+        """ Copy the current DQN weights into the target network (clone_dqn), in place """
+        
+        self.clone_dqn.load_snapshot(self.dqn.weights)
     
     def train(self, batch_size=1, num_batches=100):
         """ Train DQN with experience replay """
@@ -229,7 +225,7 @@ class AgentDQN(Agent):
         for iter_batch in range(num_batches):
             self.cur_bellman_err = 0
             for iter in range(len(self.experience_replay_pool)/(batch_size)):
-                batch = [random.choice(self.experience_replay_pool) for i in xrange(batch_size)]
+                batch = self.experience_replay_pool.sample(batch_size)
                 batch_struct = self.dqn.singleBatch(batch, {'gamma': self.gamma}, self.clone_dqn)
                 self.cur_bellman_err += batch_struct['cost']['total_cost']
             
@@ -243,7 +239,7 @@ class AgentDQN(Agent):
         """ Save the experience replay pool to a file """
         
         try:
-            pickle.dump(self.experience_replay_pool, open(path, "wb"))
+            pickle.dump(self.experience_replay_pool.transitions(), open(path, "wb"))
             print 'saved model in %s' % (path, )
         except Exception, e:
             print 'Error: Writing model fails: %s' % (path, )
@@ -252,13 +248,14 @@ class AgentDQN(Agent):
     def load_experience_replay_from_file(self, path):
         """ Load the experience replay pool from a file"""
         
-        self.experience_replay_pool = pickle.load(open(path, 'rb'))
+        self.experience_replay_pool.clear()
+        self.experience_replay_pool.extend(pickle.load(open(path, 'rb')))
     
              
     def load_trained_DQN(self, path):
-        """ Load the trained DQN from a file """
+        """ Load the trained DQN from a file (a model file or a pickled checkpoint, see deep_dialog/model_file.py) """
         
-        trained_file = pickle.load(open(path, 'rb'))
+        trained_file = load_model_file(path)
         model = trained_file['model']
         
         print "trained DQN Parameters:", json.dumps(trained_file['params'], indent=2)
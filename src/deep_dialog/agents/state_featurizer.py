@@ -0,0 +1,194 @@
+'''
+The state representation of the DQN agent, written in place
+
+- The column of every act, slot, turn and KB feature is computed once, from the act and slot sets
+- A state is encoded by zeroing one row and setting its active columns, instead of building and stacking one array per block
+- The layout is the one of the original AgentDQN representation:
+  user act, user inform slots, user request slots, agent act, agent inform slots, agent request slots,
+  current slots, turn, one-hot turn, KB binary results, KB scaled counts
+- IncrementalStateEncoder keeps the representation of one dialog up to date as the state tracker records
+  each action, so that a state snapshot carries its representation at a constant cost
+
+'''
+
+import numpy as np
+
+
+class StateFeaturizer:
+
+    def __init__(self, act_set, slot_set, max_turn, dtype=np.float64):
+        """ Constructor for a StateFeaturizer
+
+        Arguments:
+        act_set         --  The dialog act dictionary (act -> id)
+        slot_set        --  The slot dictionary (slot -> id)
+        max_turn        --  The size of the one-hot turn block
+        dtype           --  The type of the representations
+        """
+
+        self.max_turn = max_turn
+        self.dtype = dtype
+
+        act_cardinality = len(act_set)
+        slot_cardinality = len(slot_set)
+        blocks = [('user_act', act_cardinality), ('user_inform_slots', slot_cardinality), ('user_request_slots', slot_cardinality),
+                  ('agent_act', act_cardinality), ('agent_inform_slots', slot_cardinality), ('agent_request_slots', slot_cardinality),
+                  ('current_slots', slot_cardinality), ('turn', 1), ('turn_onehot', max_turn),
+                  ('kb_binary', slot_cardinality + 1), ('kb_count', slot_cardinality + 1)]
+
+        self.offsets = {}
+        self.dimension = 0
+        for name, size in blocks:
+            self.offsets[name] = self.dimension
+            self.dimension += size
+
+        # act/slot -> column of the representation, per block
+        self.columns = {}
+        for name, size in blocks:
+            if name.startswith('turn'): continue
+            reference = act_set if name.endswith('_act') else slot_set
+            self.columns[name] = dict((key, self.offsets[name] + i) for key, i in reference.items())
+
+        self.kb_binary_block = slice(self.offsets['kb_binary'], self.offsets['kb_binary'] + slot_cardinality + 1)
+        self.kb_count_block = slice(self.offsets['kb_count'], self.offsets['kb_count'] + slot_cardinality + 1)
+
+    def new_row(self):
+        """ An empty (1, dimension) representation """
+
+        return np.zeros((1, self.dimension), dtype=self.dtype)
+
+    def featurize(self, state, out=None):
+        """ Encode an agent state (see StateTracker.get_state_for_agent)
+
+        Arguments:
+        state           --  The state to encode
+        out             --  An optional (1, dimension) array overwritten with the representation; a new one otherwise
+
+        Returns the (1, dimension) representation.
+        """
+
+        if out is None:
+            out = self.new_row()
+        else:
+            out.fill(0)
+        row = out.reshape(-1)
+        columns = self.columns
+
+        self.write_action(row, 'user', state['user_action'])
+        for slot in state['current_slots']['inform_slots']:
+            row[columns['current_slots'][slot]] = 1.0
+        if state['agent_action']:
+            self.write_action(row, 'agent', state['agent_action'])
+
+        turn = state['turn']
+        if not 0 <= turn < self.max_turn:
+            raise IndexError("turn %s is out of the one-hot turn range (%s turns)" % (turn, self.max_turn))
+        row[self.offsets['turn']] = turn / 10.
+        row[self.offsets['turn_onehot'] + turn] = 1.0
+
+        self.write_kb_results(row, state['kb_results_dict'])
+        return out
+
+    def write_action(self, row, block, action):
+        """ Set the act, inform slots and request slots columns of action in the 'user' or 'agent' blocks of row """
+
+        columns = self.columns
+        row[columns[block + '_act'][action['diaact']]] = 1.0
+        for slot in action['inform_slots']:
+            row[columns[block + '_inform_slots'][slot]] = 1.0
+        for slot in action['request_slots']:
+            row[columns[block + '_request_slots'][slot]] = 1.0
+
+    def write_kb_results(self, row, kb_results_dict):
+        """ Overwrite the KB blocks of row """
+
+        matching_all = kb_results_dict['matching_all_constraints']
+        row[self.kb_binary_block] = matching_all > 0.
+        row[self.kb_count_block] = matching_all / 100.
+        binary_columns = self.columns['kb_binary']
+        count_columns = self.columns['kb_count']
+        for slot, count in kb_results_dict.items():
+            if slot in binary_columns:
+                row[binary_columns[slot]] = count > 0.
+                row[count_columns[slot]] = count / 100.
+
+
+class IncrementalStateEncoder:
+    """ The representation of the state of one dialog, updated with each action recorded by a StateTracker """
+
+    def __init__(self, featurizer):
+        """ Constructor for an IncrementalStateEncoder
+
+        Arguments:
+        featurizer      --  The StateFeaturizer giving the layout of the representation
+
+        Class Variables:
+        row             --  The representation being maintained, (1, dimension)
+        turn            --  The turn count the row encodes
+        valid           --  False once an action could not be encoded (unknown act or slot), or the turn is out of the
+                            one-hot range: the states are then left to StateFeaturizer.featurize, which reports it
+        kb_stale        --  Whether the informed slots changed since the KB blocks were written
+        """
+
+        self.featurizer = featurizer
+        self.row = featurizer.new_row()
+        self.flat = self.row.reshape(-1)
+
+        offsets = featurizer.offsets
+        self.user_block = slice(offsets['user_act'], offsets['agent_act'])
+        self.agent_block = slice(offsets['agent_act'], offsets['current_slots'])
+        self.initialize_episode()
+
+    def initialize_episode(self):
+        self.row.fill(0)
+        self.turn = 0
+        self.valid = True
+        self.kb_stale = True
+        self.set_turn(0)
+
+    def set_turn(self, turn):
+        offsets = self.featurizer.offsets
+        if 0 <= self.turn < self.featurizer.max_turn:
+            self.flat[offsets['turn_onehot'] + self.turn] = 0.
+        self.turn = turn
+        self.flat[offsets['turn']] = turn / 10.
+        if 0 <= turn < self.featurizer.max_turn:
+            self.flat[offsets['turn_onehot'] + turn] = 1.0
+
+    def update(self, action, turn):
+        """ Record action, the newest entry of the dialog history: the previous newest one moves to the agent blocks
+
+        Arguments:
+        action          --  The history record of the action (diaact, inform_slots, request_slots)
+        turn            --  The turn count after the action
+        """
+
+        flat = self.flat
+        flat[self.agent_block] = flat[self.user_block]
+        flat[self.user_block] = 0.
+        try:
+            self.featurizer.write_action(flat, 'user', action)
+            current_columns = self.featurizer.columns['current_slots']
+            for slot in action['inform_slots']:
+                flat[current_columns[slot]] = 1.0
+        except KeyError:
+            self.valid = False
+        if len(action['inform_slots']) > 0:
+            self.kb_stale = True
+        self.set_turn(turn)
+
+    def representation(self, kb_results_dict):
+        """ A read-only copy of the representation of the current state, None when it cannot be encoded
+
+        Arguments:
+        kb_results_dict --  The KB results of the current state (see KBHelper.database_results_for_agent)
+        """
+
+        if not self.valid or not 0 <= self.turn < self.featurizer.max_turn:
+            return None
+        if self.kb_stale:
+            self.featurizer.write_kb_results(self.flat, kb_results_dict)
+            self.kb_stale = False
+        representation = self.row.copy()
+        representation.flags.writeable = False
+        return representation
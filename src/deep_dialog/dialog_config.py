@@ -46,6 +46,7 @@ CONSTRAINT_CHECK_SUCCESS = 1
 #  NLG Beam Search
 ################################################################################
 nlg_beam_size = 10
+nlg_cache_size = 1000 # the number of model generated (delexicalized) sentences memoized by nlg, 0 to disable
 
 ################################################################################
 #  run_mode: 0 for dia-act; 1 for NL; 2 for no output
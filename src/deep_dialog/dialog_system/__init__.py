@@ -1,5 +1,9 @@
+from .state_snapshot import *
+from .kb_cache import *
+from .trace_writer import *
 from .kb_helper import *
 from .state_tracker import *
 from .dialog_manager import *
+from .batched_dialog_manager import *
 from .dict_reader import *
 from .utils import *
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+A dialog manager stepping several simulated dialogs in lockstep
+
+Every dialog (lane) keeps its own DialogManager, StateTracker and user simulator, while the agent is shared:
+the agent decisions of all the lanes are taken together (one DQN forward pass per step) and the per-dialog
+attributes of the agent are swapped in and out around each lane's turn. With an inference server, the model based
+user simulators of all the lanes are answered in batches as well.
+"""
+
+from . import DialogManager
+
+
+class BatchedDialogManager:
+    """ Run K dialogs between one agent and K user simulators, one agent decision batch per step """
+
+    def __init__(self, agent, users, act_set, slot_set, movie_dictionary, params=None, inference_server=None, trace_writer=None):
+        """ Constructor for a BatchedDialogManager
+
+        Arguments:
+        agent               --  The shared agent; it must implement state_to_action_batch, episode_context and set_episode_context
+        users               --  One user simulator per lane
+        act_set, slot_set   --  The dialog act and slot dictionaries
+        movie_dictionary    --  The KB
+        params              --  The KB helper parameters (see DialogManager)
+        inference_server    --  An optional UserSimulatorInferenceServer batching the user simulator predictions;
+                                without it each user simulator predicts on its own
+        trace_writer        --  An optional TraceWriter shared by the lanes
+        """
+
+        for method in ('state_to_action_batch', 'episode_context', 'set_episode_context'):
+            if not hasattr(agent, method):
+                raise ValueError("%s does not support batched dialogs (no %s)" % (agent.__class__.__name__, method))
+
+        self.agent = agent
+        self.inference_server = inference_server
+        self.lanes = [DialogManager(agent, user, act_set, slot_set, movie_dictionary, params, trace_writer) for user in users]
+        self.episode_contexts = [None] * len(self.lanes)
+        self.active = [False] * len(self.lanes)
+        self.cumulative_rewards = [0] * len(self.lanes)
+
+    def __len__(self):
+        return len(self.lanes)
+
+    def initialize_episode(self, lane_id):
+        """ Start a new dialog on lane lane_id """
+
+        lane = self.lanes[lane_id]
+        lane.initialize_episode()
+        self.episode_contexts[lane_id] = self.agent.episode_context()
+        self.active[lane_id] = True
+        self.cumulative_rewards[lane_id] = 0
+
+    def next_turn(self, record_training_data=True):
+        """ Play one turn on every active lane
+
+        Returns a list of (lane_id, episode_over, reward) for the lanes that took a turn.
+        """
+
+        lane_ids = [i for i in xrange(len(self.lanes)) if self.active[i]]
+        if len(lane_ids) == 0: return []
+
+        states = [self.lanes[i].state_tracker.get_state_for_agent() for i in lane_ids]
+        contexts = [self.episode_contexts[i] for i in lane_ids]
+        agent_actions = self.agent.state_to_action_batch(states, contexts)
+
+        for i, state, context, agent_action in zip(lane_ids, states, contexts, agent_actions):
+            lane = self.lanes[i]
+            lane.state = state
+            lane.agent_action = agent_action
+            lane.register_agent_action()
+            self.episode_contexts[i] = context
+
+        user_responses = self.user_responses(lane_ids)
+
+        outcomes = []
+        for i, user_response in zip(lane_ids, user_responses):
+            self.agent.set_episode_context(self.episode_contexts[i])
+            episode_over, reward = self.lanes[i].complete_user_turn(user_response, record_training_data)
+            self.episode_contexts[i] = self.agent.episode_context()
+
+            self.cumulative_rewards[i] += reward
+            if episode_over: self.active[i] = False
+            outcomes.append((i, episode_over, reward))
+        return outcomes
+
+    def user_responses(self, lane_ids):
+        """ The user responses of the given lanes, the batchable predictions going through the inference server """
+
+        batched = []
+        if self.inference_server is not None:
+            batched = [i for i in lane_ids if not self.lanes[i].user.rulebase and not self.lanes[i].user_rule_style()
+                       and self.inference_server.supports(self.lanes[i].user)]
+
+        responses = {}
+        if len(batched) > 0:
+            requests = [(self.lanes[i].user, self.lanes[i].user.observe(self.lanes[i].sys_action)) for i in batched]
+            for i, pred_action in zip(batched, self.inference_server.predict(requests)):
+                responses[i] = self.lanes[i].user.respond(pred_action)
+        for i in lane_ids:
+            if i not in responses:
+                responses[i] = self.lanes[i].user_next()
+        return [responses[i] for i in lane_ids]
+
+    def run_episodes(self, count, record_training_data=True):
+        """ Play count dialogs, keeping up to len(self) of them in flight
+
+        Returns one (final reward, cumulative reward, turns) tuple per dialog, in the order the dialogs finished.
+        """
+
+        results = []
+        started = 0
+        for i in xrange(len(self.lanes)):
+            if started == count: break
+            self.initialize_episode(i)
+            started += 1
+
+        while any(self.active):
+            for i, episode_over, reward in self.next_turn(record_training_data):
+                if not episode_over: continue
+                results.append((reward, self.cumulative_rewards[i], self.lanes[i].state_tracker.turn_count))
+                if started < count:
+                    self.initialize_episode(i)
+                    started += 1
+        return results
@@ -12,15 +12,18 @@ from deep_dialog import dialog_config
 class DialogManager:
     """ A dialog manager to mediate the interaction between an agent and a customer """
     
-    def __init__(self, agent, user, act_set, slot_set, movie_dictionary):
+    def __init__(self, agent, user, act_set, slot_set, movie_dictionary, params=None, trace_writer=None):
         self.agent = agent
         self.user = user
         self.act_set = act_set
         self.slot_set = slot_set
-        self.state_tracker = StateTracker(act_set, slot_set, movie_dictionary)
+        state_encoder = agent.new_state_encoder() if hasattr(agent, 'new_state_encoder') else None # incremental agent state representation
+        self.state_tracker = StateTracker(act_set, slot_set, movie_dictionary, params, state_encoder)
         self.user_action = None
         self.reward = 0
         self.episode_over = False
+        self.trace_writer = trace_writer # optional TraceWriter recording every dialog
+        self.trace_episode = None
 
     def initialize_episode(self):
         """ Refresh state for new dialog """
@@ -35,6 +38,9 @@ class DialogManager:
             print ("New episode, user goal:")
             print json.dumps(self.user.goal, indent=2)
         self.print_function(user_action = self.user_action)
+        if self.trace_writer is not None:
+            self.trace_episode = self.trace_writer.begin_episode(self.user.goal)
+            self.trace_writer.turn(self.trace_episode, 'usr', self.user_action)
             
         self.agent.initialize_episode()
 
@@ -47,6 +53,17 @@ class DialogManager:
         self.state = self.state_tracker.get_state_for_agent()
         self.agent_action = self.agent.state_to_action(self.state)
         
+        return self.complete_turn(record_training_data)
+    
+    def complete_turn(self, record_training_data=True):
+        """ Complete the turn once the agent has chosen self.agent_action for self.state: user response, reward, replay tuple """
+        
+        self.register_agent_action()
+        return self.complete_user_turn(self.user_next(), record_training_data)
+    
+    def register_agent_action(self):
+        """ Register the agent action with the state tracker, set self.sys_action for the user """
+        
         ########################################################################
         #   Register AGENT action with the state_tracker
         ########################################################################
@@ -54,17 +71,29 @@ class DialogManager:
         
         self.agent.add_nl_to_action(self.agent_action) # add NL to Agent Dia_Act
         self.print_function(agent_action = self.agent_action['act_slot_response'])
+        if self.trace_writer is not None:
+            self.trace_writer.turn(self.trace_episode, 'sys', self.agent_action['act_slot_response'])
         
-        ########################################################################
-        #   CALL USER TO TAKE HER TURN
-        ########################################################################
         self.sys_action = self.state_tracker.dialog_history_dictionaries()[-1]
-
+    
+    def user_rule_style(self):
+        """ Whether a model based user simulator should answer with its rules (warm start) """
+        
+        return hasattr(self.agent, 'warm_start') and self.agent.warm_start == 1
+    
+    def user_next(self):
+        """ CALL USER TO TAKE HER TURN: returns (user_action, episode_over, dialog_status) """
+        
         if self.user.rulebase:
-            self.user_action, self.episode_over, dialog_status = self.user.next(self.sys_action)
+            return self.user.next(self.sys_action)
         else:
             # use rule base method to warm start
-            self.user_action, self.episode_over, dialog_status = self.user.next(self.sys_action, (hasattr(self.agent, 'warm_start') and self.agent.warm_start == 1))
+            return self.user.next(self.sys_action, self.user_rule_style())
+    
+    def complete_user_turn(self, user_response, record_training_data=True):
+        """ Reward the user response (user_action, episode_over, dialog_status), update the state tracker and the agent """
+        
+        self.user_action, self.episode_over, dialog_status = user_response
         self.reward = self.reward_function(dialog_status)
         
         ########################################################################
@@ -73,6 +102,10 @@ class DialogManager:
         if self.episode_over != True:
             self.state_tracker.update(user_action = self.user_action)
             self.print_function(user_action = self.user_action)
+            if self.trace_writer is not None:
+                self.trace_writer.turn(self.trace_episode, 'usr', self.user_action)
+        elif self.trace_writer is not None:
+            self.trace_writer.end_episode(self.trace_episode, dialog_status == dialog_config.SUCCESS_DIALOG)
 
         ########################################################################
         #  Inform agent of the outcome for this timestep (s_t, a_t, r, s_{t+1}, episode_over)
@@ -0,0 +1,9 @@
+"""
+A bounded LRU cache for the KB query results of KBHelper
+"""
+
+from deep_dialog.lru_cache import LRUCache
+
+
+class KBCache(LRUCache):
+    """ The LRU cache of KB query results, bounded by a number of entries and/or an (estimated) number of bytes """
@@ -5,18 +5,87 @@ Created on May 18, 2016
 """
 
 import copy
+import numpy as np
 from collections import defaultdict
 from deep_dialog import dialog_config
+from .kb_cache import KBCache
+
+
+def normalize_slot_value(value):
+    """ The form under which slot values are compared against the KB (case-insensitive string) """
+    
+    try:
+        return str(value).lower()
+    except UnicodeEncodeError:
+        return value.lower()
+
 
 class KBHelper:
     """ An assistant to fill in values for the agent (which knows about slots of values) """
     
-    def __init__(self, movie_dictionary):
-        """ Constructor for a KBHelper """
+    def __init__(self, movie_dictionary, params=None):
+        """ Constructor for a KBHelper
+
+        Arguments:
+        movie_dictionary        --  The movie KB, movie_id -> {slot: value}
+        params                  --  Optional cache settings:
+                                    kb_cache_max_entries (default 10000, None for unbounded),
+                                    kb_cache_max_bytes (default None),
+                                    kb_cache_normalize_keys (default True: key on the lowercased values of the constraining slots only)
+        """
         
+        params = params or {}
         self.movie_dictionary = movie_dictionary
-        self.cached_kb = defaultdict(list)
-        self.cached_kb_slot = defaultdict(list)
+        self.normalize_cache_keys = params.get('kb_cache_normalize_keys', True)
+        
+        max_entries = params.get('kb_cache_max_entries', 10000)
+        max_bytes = params.get('kb_cache_max_bytes', None)
+        self.cached_kb = KBCache(max_entries, max_bytes, sizeof=lambda positions: positions.nbytes)
+        self.cached_kb_slot = KBCache(max_entries, max_bytes)
+        self.build_index()
+
+
+    def build_index(self):
+        """ Build the inverted index slot -> normalized value -> sorted array of movie positions (into self.movie_ids) """
+        
+        self.movie_ids = list(self.movie_dictionary.keys())
+        self.all_movie_positions = np.arange(len(self.movie_ids), dtype=np.int32)
+        
+        postings = defaultdict(lambda: defaultdict(list))
+        for position, movie_id in enumerate(self.movie_ids):
+            for slot, value in self.movie_dictionary[movie_id].items():
+                postings[slot][normalize_slot_value(value)].append(position)
+        
+        self.slot_value_index = {}
+        for slot in postings:
+            self.slot_value_index[slot] = dict((value, np.array(positions, dtype=np.int32)) for value, positions in postings[slot].items())
+        self.empty_positions = np.zeros(0, dtype=np.int32)
+    
+    
+    def movie_positions(self, slot, value):
+        """ Sorted positions of the movies whose slot matches value (case-insensitive) """
+        
+        return self.slot_value_index.get(slot, {}).get(normalize_slot_value(value), self.empty_positions)
+    
+    
+    def matching_positions(self, constraints):
+        """ Sorted positions of the movies matching every (slot, value) constraint, by intersecting the posting arrays """
+        
+        if len(constraints) == 0:
+            return self.all_movie_positions
+        
+        postings = sorted([self.movie_positions(slot, value) for slot, value in constraints], key=len)
+        positions = postings[0]
+        for other in postings[1:]:
+            if len(positions) == 0: break
+            positions = np.intersect1d(positions, other, assume_unique=True)
+        return positions
+    
+    
+    def cache_stats(self):
+        """ Hit/miss/eviction counters of the KB query caches """
+        
+        return {'kb': self.cached_kb.stats(), 'kb_slot': self.cached_kb_slot.stats()}
 
 
     def fill_inform_slots(self, inform_slots_to_be_filled, current_slots):
@@ -81,7 +150,6 @@ class KBHelper:
     def available_results_from_kb(self, current_slots):
         """ Return the available movies in the movie_kb based on the current constraints """
         
-        ret_result = []
         current_slots = current_slots['inform_slots']
         constrain_keys = current_slots.keys()
 
@@ -91,76 +159,39 @@ class KBHelper:
                                            k != 'closing' , constrain_keys)
         constrain_keys = [k for k in constrain_keys if current_slots[k] != dialog_config.I_DO_NOT_CARE]
 
-        query_idx_keys = frozenset(current_slots.items())
-        cached_kb_ret = self.cached_kb[query_idx_keys]
-
-        cached_kb_length = len(cached_kb_ret) if cached_kb_ret != None else -1
-        if cached_kb_length > 0:
-            return dict(cached_kb_ret)
-        elif cached_kb_length == -1:
-            return dict([])
-
-        # kb_results = copy.deepcopy(self.movie_dictionary)
-        for id in self.movie_dictionary.keys():
-            kb_keys = self.movie_dictionary[id].keys()
-            if len(set(constrain_keys).union(set(kb_keys)) ^ (set(constrain_keys) ^ set(kb_keys))) == len(
-                    constrain_keys):
-                match = True
-                for idx, k in enumerate(constrain_keys):
-                    if str(current_slots[k]).lower() == str(self.movie_dictionary[id][k]).lower():
-                        continue
-                    else:
-                        match = False
-                if match:
-                    self.cached_kb[query_idx_keys].append((id, self.movie_dictionary[id]))
-                    ret_result.append((id, self.movie_dictionary[id]))
-
-            # for slot in current_slots['inform_slots'].keys():
-            #     if slot == 'ticket' or slot == 'numberofpeople' or slot == 'taskcomplete' or slot == 'closing': continue
-            #     if current_slots['inform_slots'][slot] == dialog_config.I_DO_NOT_CARE: continue
-            #
-            #     if slot not in self.movie_dictionary[movie_id].keys():
-            #         if movie_id in kb_results.keys():
-            #             del kb_results[movie_id]
-            #     else:
-            #         if current_slots['inform_slots'][slot].lower() != self.movie_dictionary[movie_id][slot].lower():
-            #             if movie_id in kb_results.keys():
-            #                 del kb_results[movie_id]
-            
-        if len(ret_result) == 0:
-            self.cached_kb[query_idx_keys] = None
+        if self.normalize_cache_keys:
+            query_idx_keys = frozenset((k, normalize_slot_value(current_slots[k])) for k in constrain_keys)
+        else:
+            query_idx_keys = frozenset(current_slots.items())
+        
+        positions = self.cached_kb.get(query_idx_keys)
+        if positions is None:
+            positions = self.matching_positions([(k, current_slots[k]) for k in constrain_keys])
+            self.cached_kb.put(query_idx_keys, positions)
 
-        ret_result = dict(ret_result)
+        ret_result = dict((self.movie_ids[position], self.movie_dictionary[self.movie_ids[position]]) for position in positions)
         return ret_result
     
     def available_results_from_kb_for_slots(self, inform_slots):
         """ Return the count statistics for each constraint in inform_slots """
         
+        constrain_keys = [slot for slot in inform_slots.keys() if slot != 'ticket' and inform_slots[slot] != dialog_config.I_DO_NOT_CARE]
+        
+        if self.normalize_cache_keys:
+            query_idx_keys = frozenset((slot, normalize_slot_value(inform_slots[slot])) for slot in constrain_keys)
+        else:
+            query_idx_keys = frozenset(inform_slots.items())
+        
+        slot_counts = self.cached_kb_slot.get(query_idx_keys)
+        if slot_counts is None:
+            slot_counts = {}
+            for slot in constrain_keys:
+                slot_counts[slot] = len(self.movie_positions(slot, inform_slots[slot]))
+            slot_counts['matching_all_constraints'] = len(self.matching_positions([(slot, inform_slots[slot]) for slot in constrain_keys]))
+            self.cached_kb_slot.put(query_idx_keys, slot_counts)
+        
         kb_results = {key:0 for key in inform_slots.keys()}
-        kb_results['matching_all_constraints'] = 0
-        
-        query_idx_keys = frozenset(inform_slots.items())
-        cached_kb_slot_ret = self.cached_kb_slot[query_idx_keys]
-
-        if len(cached_kb_slot_ret) > 0:
-            return cached_kb_slot_ret[0]
-
-        for movie_id in self.movie_dictionary.keys():
-            all_slots_match = 1
-            for slot in inform_slots.keys():
-                if slot == 'ticket' or inform_slots[slot] == dialog_config.I_DO_NOT_CARE:
-                    continue
-
-                if slot in self.movie_dictionary[movie_id].keys():
-                    if inform_slots[slot].lower() == self.movie_dictionary[movie_id][slot].lower():
-                        kb_results[slot] += 1
-                    else:
-                        all_slots_match = 0
-                else:
-                    all_slots_match = 0
-            kb_results['matching_all_constraints'] += all_slots_match
-
-        self.cached_kb_slot[query_idx_keys].append(kb_results)
+        kb_results.update(slot_counts)
         return kb_results
 
     
@@ -0,0 +1,82 @@
+"""
+Immutable views of the dialog state handed out by the StateTracker
+
+The tracker keeps every per-turn record and its current slots frozen, so a snapshot of the state only
+references them (structural sharing) instead of deep-copying the dialog history every turn.
+"""
+
+
+class FrozenDict(dict):
+    """ A read-only dictionary; deep copies of it are plain (mutable) dictionaries """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("'%s' object is read-only" % (self.__class__.__name__,))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class HistoryView(object):
+    """ A read-only view over the first length records of an append-only list """
+
+    def __init__(self, records, length=None):
+        self.records = records
+        self.length = len(records) if length is None else length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self.records[:self.length][index])
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('history index out of range')
+        return self.records[index]
+
+    def __iter__(self):
+        for index in xrange(self.length):
+            yield self.records[index]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(obj):
+    """ Return a read-only copy of a (nested) dict/list structure """
+
+    if isinstance(obj, FrozenDict):
+        return obj
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj):
+    """ Return a mutable copy of a structure built by freeze """
+
+    if isinstance(obj, dict):
+        return dict((k, thaw(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, HistoryView)):
+        return [thaw(v) for v in obj]
+    return obj
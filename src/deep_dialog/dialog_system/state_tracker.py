@@ -7,6 +7,7 @@ state tracker
 """
 
 from . import KBHelper
+from .state_snapshot import FrozenDict, HistoryView, freeze, thaw
 import numpy as np
 import copy
 
@@ -14,56 +15,62 @@ import copy
 class StateTracker:
     """ The state tracker maintains a record of which request slots are filled and which inform slots are filled """
 
-    def __init__(self, act_set, slot_set, movie_dictionary):
+    def __init__(self, act_set, slot_set, movie_dictionary, params=None, state_encoder=None):
         """ constructor for statetracker takes movie knowledge base and initializes a new episode
 
         Arguments:
         act_set                 --  The set of all acts availavle
         slot_set                --  The total set of available slots
         movie_dictionary        --  A representation of all the available movies. Generally this object is accessed via the KBHelper class
+        params                  --  Optional settings passed on to the KBHelper (KB cache size/normalization)
+        state_encoder           --  An optional encoder of the agent state representation (see AgentDQN.new_state_encoder),
+                                    told every recorded action; the states for the agent then carry their 'representation'
 
         Class Variables:
-        history_vectors         --  A record of the current dialog so far in vector format (act-slot, but no values)
-        history_dictionaries    --  A record of the current dialog in dictionary format
-        current_slots           --  A dictionary that keeps a running record of which slots are filled current_slots['inform_slots'] and which are requested current_slots['request_slots'] (but not filed)
+        history_dictionaries    --  A record of the current dialog in dictionary format (append-only list of frozen per-turn records)
+        current_slots           --  A (frozen) dictionary that keeps a running record of which slots are filled current_slots['inform_slots'] and which are requested current_slots['request_slots'] (but not filed)
         action_dimension        --  # TODO indicates the dimensionality of the vector representaiton of the action
         kb_result_dimension     --  A single integer denoting the dimension of the kb_results features.
         turn_count              --  A running count of which turn we are at in the present dialog
         """
         self.movie_dictionary = movie_dictionary
+        self.state_encoder = state_encoder
         self.initialize_episode()
-        self.history_vectors = None
         self.history_dictionaries = None
         self.current_slots = None
         self.action_dimension = 10      # TODO REPLACE WITH REAL VALUE
         self.kb_result_dimension = 10   # TODO  REPLACE WITH REAL VALUE
         self.turn_count = 0
-        self.kb_helper = KBHelper(movie_dictionary)
+        self.kb_helper = KBHelper(movie_dictionary, params)
         
 
     def initialize_episode(self):
         """ Initialize a new episode (dialog), flush the current state and tracked slots """
         
         self.action_dimension = 10
-        self.history_vectors = np.zeros((1, self.action_dimension))
         self.history_dictionaries = []
         self.turn_count = 0
-        self.current_slots = {}
-        
-        self.current_slots['inform_slots'] = {}
-        self.current_slots['request_slots'] = {}
-        self.current_slots['proposed_slots'] = {}
-        self.current_slots['agent_request_slots'] = {}
+        self.current_slots = freeze({'inform_slots': {}, 'request_slots': {}, 'proposed_slots': {}, 'agent_request_slots': {}})
+        if self.state_encoder is not None:
+            self.state_encoder.initialize_episode()
 
 
     def dialog_history_vectors(self):
-        """ Return the dialog history (both user and agent actions) in vector representation """
-        return self.history_vectors
+        """ Return the dialog history (both user and agent actions) in vector representation
+
+        The (1 + #turns, action_dimension) matrix is built on request from history_dictionaries: a leading
+        zero row, then a row of ones for each agent action and a row of zeros for each user action.
+        """
+        history_vectors = np.zeros((len(self.history_dictionaries) + 1, self.action_dimension))
+        for index, action in enumerate(self.history_dictionaries):
+            if action['speaker'] == "agent":
+                history_vectors[index + 1] = 1
+        return history_vectors
 
 
     def dialog_history_dictionaries(self):
         """  Return the dictionary representation of the dialog history (includes values) """
-        return self.history_dictionaries
+        return HistoryView(self.history_dictionaries)
 
 
     def kb_results_for_state(self):
@@ -78,12 +85,19 @@ class StateTracker:
         
 
     def get_state_for_agent(self):
-        """ Get the state representatons to send to agent """
+        """ Get the state representatons to send to agent
+
+        The state is a read-only snapshot: the per-turn records and current slots are frozen and shared with
+        the tracker, so taking a snapshot does not copy the dialog history. copy.deepcopy(state) gives a mutable copy.
+        """
         #state = {'user_action': self.history_dictionaries[-1], 'current_slots': self.current_slots, 'kb_results': self.kb_results_for_state()}
+        kb_results_dict = self.kb_helper.database_results_for_agent(self.current_slots)
         state = {'user_action': self.history_dictionaries[-1], 'current_slots': self.current_slots, #'kb_results': self.kb_results_for_state(), 
-                 'kb_results_dict':self.kb_helper.database_results_for_agent(self.current_slots), 'turn': self.turn_count, 'history': self.history_dictionaries, 
+                 'kb_results_dict': freeze(kb_results_dict), 'turn': self.turn_count, 'history': HistoryView(self.history_dictionaries), 
                  'agent_action': self.history_dictionaries[-2] if len(self.history_dictionaries) > 1 else None}
-        return copy.deepcopy(state)
+        if self.state_encoder is not None:
+            state['representation'] = self.state_encoder.representation(kb_results_dict)
+        return FrozenDict(state)
     
     def get_suggest_slots_values(self, request_slots):
         """ Get the suggested values for request slots """
@@ -108,6 +122,9 @@ class StateTracker:
         ########################################################################
         assert(not (user_action and agent_action))
         assert(user_action or agent_action)
+        
+        # the frozen current slots may be shared with snapshots handed out earlier: update a copy
+        current_slots = thaw(self.current_slots)
 
         ########################################################################
         #   Update state to reflect a new action by the agent.
@@ -135,18 +152,16 @@ class StateTracker:
             #   This code should execute regardless of which kind of agent produced action
             ####################################################################
             for slot in agent_action_values['inform_slots'].keys():
-                self.current_slots['proposed_slots'][slot] = agent_action_values['inform_slots'][slot]
-                self.current_slots['inform_slots'][slot] = agent_action_values['inform_slots'][slot] # add into inform_slots
-                if slot in self.current_slots['request_slots'].keys():
-                    del self.current_slots['request_slots'][slot]
+                current_slots['proposed_slots'][slot] = agent_action_values['inform_slots'][slot]
+                current_slots['inform_slots'][slot] = agent_action_values['inform_slots'][slot] # add into inform_slots
+                if slot in current_slots['request_slots'].keys():
+                    del current_slots['request_slots'][slot]
 
             for slot in agent_action_values['request_slots'].keys():
-                if slot not in self.current_slots['agent_request_slots']:
-                    self.current_slots['agent_request_slots'][slot] = "UNK"
+                if slot not in current_slots['agent_request_slots']:
+                    current_slots['agent_request_slots'][slot] = "UNK"
 
-            self.history_dictionaries.append(agent_action_values)
-            current_agent_vector = np.ones((1, self.action_dimension))
-            self.history_vectors = np.vstack([self.history_vectors, current_agent_vector])
+            self.history_dictionaries.append(freeze(agent_action_values))
                             
         ########################################################################
         #   Update the state to reflect a new action by the user
@@ -157,17 +172,16 @@ class StateTracker:
             #   Update the current slots
             ####################################################################
             for slot in user_action['inform_slots'].keys():
-                self.current_slots['inform_slots'][slot] = user_action['inform_slots'][slot]
-                if slot in self.current_slots['request_slots'].keys():
-                    del self.current_slots['request_slots'][slot]
+                current_slots['inform_slots'][slot] = user_action['inform_slots'][slot]
+                if slot in current_slots['request_slots'].keys():
+                    del current_slots['request_slots'][slot]
 
             for slot in user_action['request_slots'].keys():
-                if slot not in self.current_slots['request_slots']:
-                    self.current_slots['request_slots'][slot] = "UNK"
+                if slot not in current_slots['request_slots']:
+                    current_slots['request_slots'][slot] = "UNK"
             
-            self.history_vectors = np.vstack([self.history_vectors, np.zeros((1,self.action_dimension))])
             new_move = {'turn': self.turn_count, 'speaker': "user", 'request_slots': user_action['request_slots'], 'inform_slots': user_action['inform_slots'], 'diaact': user_action['diaact']}
-            self.history_dictionaries.append(copy.deepcopy(new_move))
+            self.history_dictionaries.append(freeze(new_move))
 
         ########################################################################
         #   This should never happen if the asserts passed
@@ -178,4 +192,7 @@ class StateTracker:
         ########################################################################
         #   This code should execute after update code regardless of what kind of action (agent/user)
         ########################################################################
-        self.turn_count += 1
\ No newline at end of file
+        self.current_slots = freeze(current_slots)
+        self.turn_count += 1
+        if self.state_encoder is not None:
+            self.state_encoder.update(self.history_dictionaries[-1], self.turn_count)
\ No newline at end of file
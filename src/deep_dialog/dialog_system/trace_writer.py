@@ -0,0 +1,179 @@
+"""
+Structured traces of the simulated dialogs
+
+A DialogManager given a trace writer records every dialog as compact records instead of (or along with) the
+printed log: an 'episode' record with the user goal, one 'turn' record per dialog act and an 'outcome' record.
+Records are encoded when written and flushed to the file in batches. The turn records of dialogs played in
+lockstep (BatchedDialogManager) interleave, they are tied together by their episode id.
+
+Two formats: JSON lines (.jsonl files), and length-prefixed pickles (any other file name), which are faster
+to write and read. A TraceRecorder keeps the records of a worker process in memory, for the TraceWriter of the
+main process to write them (write_records).
+"""
+
+import json
+import struct
+import cPickle as pickle
+
+TRACE_VERSION = 1
+BINARY_TRACE_MAGIC = 'DDTRACE1'
+RECORD_LENGTH = struct.Struct('<I')
+
+
+class TraceWriter:
+    """ Buffer trace records and write them to a file every flush_every records, one JSON object per line """
+
+    def __init__(self, path, flush_every=1000):
+        """ Constructor for a TraceWriter
+
+        Arguments:
+        path            --  The trace file, overwritten
+        flush_every     --  The number of records buffered between two writes to the file
+
+        Class Variables:
+        section         --  The dataset section ('warm_start_data' or 'train_data') of the episodes being started
+        """
+
+        self.path = path
+        self.flush_every = flush_every
+        self.file = open(path, 'wb')
+        self.buffer = []
+        self.next_episode_id = 0
+        self.section = 'train_data'
+
+        self.file.write(self.header())
+        self.write({'type': 'trace', 'version': TRACE_VERSION})
+
+    def header(self):
+        """ The bytes opening the file, before the first record """
+        return ''
+
+    def encode(self, record):
+        """ The bytes of one record """
+        return json.dumps(record) + '\n'
+
+    def write(self, record):
+        self.buffer.append(self.encode(record))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered records to the file """
+
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def start_section(self, section):
+        """ Tag the episodes started from now on with section """
+        self.section = section
+
+    def begin_episode(self, user_goal):
+        """ Record the start of a dialog, return the episode id of its next records """
+
+        episode_id = self.next_episode_id
+        self.next_episode_id += 1
+        self.write({'type': 'episode', 'episode': episode_id, 'section': self.section, 'user_goal': user_goal})
+        return episode_id
+
+    def turn(self, episode_id, speaker, action):
+        """ Record the dialog act (and the utterance, if any) of speaker 'usr' or 'sys' """
+
+        self.write({'type': 'turn', 'episode': episode_id, 'turn': action['turn'], 'speaker': speaker,
+                    'diaact': action['diaact'], 'inform_slots': dict(action['inform_slots']),
+                    'request_slots': dict(action['request_slots']), 'utterance': action.get('nl', '')})
+
+    def end_episode(self, episode_id, success):
+        self.write({'type': 'outcome', 'episode': episode_id, 'success': success})
+
+    def write_records(self, records):
+        """ Write the records of a TraceRecorder as if its episodes were played here: they get the next episode ids and the current section """
+
+        episode_ids = {}
+        for record in records:
+            record = dict(record)
+            if record['type'] == 'episode':
+                episode_ids[record['episode']] = self.next_episode_id
+                self.next_episode_id += 1
+                record['section'] = self.section
+            record['episode'] = episode_ids[record['episode']]
+            self.write(record)
+
+
+class TraceRecorder(TraceWriter):
+    """ Keep the trace records in memory (e.g. in a worker process), for a TraceWriter to write them with write_records """
+
+    def __init__(self):
+        self.records = []
+        self.next_episode_id = 0
+        self.section = 'train_data'
+
+    def write(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BinaryTraceWriter(TraceWriter):
+    """ Records pickled and prefixed by their length, after a magic header """
+
+    def header(self):
+        return BINARY_TRACE_MAGIC
+
+    def encode(self, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        return RECORD_LENGTH.pack(len(payload)) + payload
+
+
+def open_trace_writer(path, flush_every=1000):
+    """ A TraceWriter (JSON lines) for a .jsonl path, a BinaryTraceWriter otherwise """
+
+    if path.endswith('.jsonl'):
+        return TraceWriter(path, flush_every)
+    return BinaryTraceWriter(path, flush_every)
+
+
+def is_trace_file(path):
+    """ Whether path was written by a TraceWriter (either format) """
+
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_TRACE_MAGIC)) == BINARY_TRACE_MAGIC:
+            return True
+        f.seek(0)
+        try:
+            record = json.loads(f.readline())
+        except ValueError:
+            return False
+        return isinstance(record, dict) and record.get('type') == 'trace'
+
+
+def iter_trace_records(path):
+    """ Yield the records of a trace file in the order they were written; a truncated last record is skipped """
+
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_TRACE_MAGIC)) == BINARY_TRACE_MAGIC:
+            while True:
+                prefix = f.read(RECORD_LENGTH.size)
+                if len(prefix) < RECORD_LENGTH.size:
+                    break
+                length = RECORD_LENGTH.unpack(prefix)[0]
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                yield pickle.loads(payload)
+        else:
+            f.seek(0)
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                yield json.loads(line)
@@ -0,0 +1,90 @@
+"""
+A bounded LRU cache, shared by the KB query caches of KBHelper and the NLG sentence memo
+"""
+
+import sys
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ A least-recently-used cache bounded by a number of entries and/or an (estimated) number of bytes """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=sys.getsizeof):
+        """ Constructor for an LRUCache
+
+        Arguments:
+        max_entries     --  The maximum number of cached entries, None for no limit
+        max_bytes       --  The maximum estimated size of the cached values, None for no limit
+        sizeof          --  A function estimating the size of a cached value in bytes
+
+        Class Variables:
+        hits, misses, evictions --  Running counters of the cache behaviour
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.entries = OrderedDict()
+        self.entry_bytes = {}
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """ Return the cached value for key (marking it as most recently used), or default on a miss """
+
+        if key not in self.entries:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """ Cache value under key, evicting the least recently used entries beyond the limits """
+
+        if key in self.entries:
+            self.remove(key)
+
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self.entries[key] = value
+        self.entry_bytes[key] = size
+        self.total_bytes += size
+
+        while (self.max_entries is not None and len(self.entries) > self.max_entries) or \
+              (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+            oldest_key = next(iter(self.entries))
+            self.remove(oldest_key)
+            self.evictions += 1
+
+    def remove(self, key):
+        """ Drop key from the cache """
+
+        del self.entries[key]
+        self.total_bytes -= self.entry_bytes.pop(key)
+
+    def clear(self):
+        """ Drop every entry, keeping the counters """
+
+        self.entries.clear()
+        self.entry_bytes.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        """ A dictionary of the cache counters """
+
+        return {'entries': len(self.entries), 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,201 @@
+'''
+Model files: the model dictionaries of the DQN checkpoints, the NLG and the NLU, in one versioned, memory-mapped container
+
+A model dictionary (the layout of the pickled models) holds the weight matrices under 'model' (name -> numpy array),
+and vocabularies, params, etc. in its other entries. The model file of a dictionary is:
+
+- a preamble: magic, format version, CRC32 of the rest of the file, header length
+- a JSON header: the name, dtype, shape and offset of each matrix, and the other entries of the dictionary
+- the matrices, raw and C ordered, each aligned on ALIGNMENT bytes
+
+Loading maps the file in memory: the matrices are read-only views of it (no copy, pages shared by the processes
+using the same file), and the checksum is verified first. load_model_file also reads pickled models, so either
+format can be given wherever a model path is expected.
+
+Conversion of pickled models: python deep_dialog/model_file.py model.p [more.p ...] [--output_dir dir]
+
+'''
+
+import argparse, json, mmap, os, struct, zlib
+import cPickle as pickle
+import numpy as np
+
+
+MAGIC = 'DDMODEL\0'
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct('<8sIIQ') # magic, version, checksum, header length
+ALIGNMENT = 64
+EXTENSION = '.model'
+CHECKSUM_CHUNK = 1 << 24
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def update_checksum(checksum, data):
+    for start in xrange(0, len(data), CHECKSUM_CHUNK):
+        checksum = zlib.crc32(data[start:start + CHECKSUM_CHUNK], checksum)
+    return checksum & 0xffffffff
+
+
+def to_str(obj):
+    """ The unicode strings decoded by json as str, as in the pickled models (the objects are converted by str_pairs_hook) """
+
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [to_str(v) for v in obj]
+    return obj
+
+
+def str_pairs_hook(pairs):
+    """ json object_pairs_hook: the objects are decoded with str keys and values """
+
+    return dict((k.encode('utf-8'), v.encode('utf-8') if isinstance(v, unicode) else (to_str(v) if isinstance(v, list) else v)) for k, v in pairs)
+
+
+def dump_model(obj, f):
+    """ Write a model dictionary to the file object f as a model file (arguments as pickle.dump)
+
+    Arguments:
+    obj             --  The model dictionary: its 'model' entry (name -> numpy array) is stored raw, the other entries as JSON
+    f               --  The binary file object written
+    """
+
+    meta = dict((key, value) for key, value in obj.items() if key != 'model')
+    for key, value in meta.items():
+        try:
+            representable = to_str(json.loads(json.dumps(value), object_pairs_hook=str_pairs_hook)) == value
+        except (TypeError, ValueError):
+            representable = False
+        if not representable:
+            raise ValueError("entry '%s' of the model dictionary cannot be stored as JSON" % (key, ))
+
+    arrays = []
+    entries = []
+    offset = 0
+    weights = obj.get('model', {})
+    for name in sorted(weights.keys()):
+        array = np.ascontiguousarray(weights[name])
+        if array.dtype.hasobject:
+            raise ValueError("matrix '%s' of the model dictionary has dtype object" % (name, ))
+        offset = aligned(offset)
+        entries.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        arrays.append(array)
+        offset += array.nbytes
+
+    header = json.dumps({'version': FORMAT_VERSION, 'arrays': entries, 'meta': meta}, sort_keys=True)
+    data_start = aligned(PREAMBLE.size + len(header))
+
+    chunks = [header, '\0' * (data_start - PREAMBLE.size - len(header))]
+    position = 0
+    for entry, array in zip(entries, arrays):
+        chunks.append('\0' * (entry['offset'] - position))
+        chunks.append(array.data)
+        position = entry['offset'] + array.nbytes
+
+    checksum = 0
+    for chunk in chunks:
+        checksum = update_checksum(checksum, chunk)
+    f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, checksum, len(header)))
+    for chunk in chunks:
+        f.write(chunk)
+
+
+def save_model_file(path, obj):
+    """ Write a model dictionary to path as a model file """
+
+    with open(path, 'wb') as f:
+        dump_model(obj, f)
+
+
+def is_model_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_model_file(path, mmap_mode='r', verify=True):
+    """ Load a model dictionary from a model file, or from a pickle
+
+    Arguments:
+    path            --  The model file (or pickled model dictionary)
+    mmap_mode       --  'r': the matrices are read-only views of the mapped file; 'c': copy-on-write views;
+                        None: the file is read in memory and the matrices are writable
+    verify          --  Whether to verify the checksum of the model file, ValueError if it does not match
+
+    Returns the model dictionary.
+    """
+
+    if not is_model_file(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    with open(path, 'rb') as f:
+        if mmap_mode is None:
+            raw = np.frombuffer(bytearray(f.read()), dtype=np.uint8)
+        else:
+            access = {'r': mmap.ACCESS_READ, 'c': mmap.ACCESS_COPY}[mmap_mode]
+            raw = np.frombuffer(mmap.mmap(f.fileno(), 0, access=access), dtype=np.uint8)
+
+    if raw.size < PREAMBLE.size:
+        raise ValueError("%s: truncated model file" % (path, ))
+    magic, version, checksum, header_length = PREAMBLE.unpack(raw[:PREAMBLE.size].tostring())
+    if version > FORMAT_VERSION:
+        raise ValueError("%s: model file version %d, this code reads versions up to %d" % (path, version, FORMAT_VERSION))
+    if verify and update_checksum(0, raw[PREAMBLE.size:]) != checksum:
+        raise ValueError("%s: checksum mismatch, the model file is corrupted" % (path, ))
+
+    header = json.loads(raw[PREAMBLE.size:PREAMBLE.size + header_length].tostring(), object_pairs_hook=str_pairs_hook)
+    data_start = aligned(PREAMBLE.size + header_length)
+
+    model = {}
+    for entry in header['arrays']:
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        start = data_start + entry['offset']
+        size = int(np.prod(shape)) * dtype.itemsize
+        if start + size > raw.size:
+            raise ValueError("%s: truncated model file" % (path, ))
+        model[entry['name']] = raw[start:start + size].view(dtype).reshape(shape)
+
+    obj = header['meta']
+    obj['model'] = model
+    return obj
+
+
+def convert_pickle(pickle_path, model_path):
+    """ Convert a pickled model dictionary into a model file, checked by loading it back """
+
+    with open(pickle_path, 'rb') as f:
+        obj = pickle.load(f)
+    save_model_file(model_path, obj)
+
+    converted = load_model_file(model_path)
+    weights = obj.get('model', {})
+    same_model = sorted(converted['model'].keys()) == sorted(weights.keys()) and all(np.array_equal(converted['model'][name], np.asarray(weights[name])) for name in weights)
+    same_meta = all(converted[key] == obj[key] for key in obj if key != 'model')
+    if not (same_model and same_meta):
+        raise ValueError("%s: the converted model differs from %s" % (model_path, pickle_path))
+    return converted
+
+
+def main(params):
+    for pickle_path in params['paths']:
+        model_path = os.path.splitext(pickle_path)[0] + EXTENSION
+        if params['output_dir'] is not None:
+            model_path = os.path.join(params['output_dir'], os.path.basename(model_path))
+
+        converted = convert_pickle(pickle_path, model_path)
+        print 'converted %s into %s: %d matrices, %d bytes (pickle %d bytes)' % (pickle_path, model_path, len(converted['model']), os.path.getsize(model_path), os.path.getsize(pickle_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('paths', nargs='+', type=str, help='the pickled models (DQN checkpoints, NLG or NLU models) to convert')
+    parser.add_argument('--output_dir', dest='output_dir', type=str, default=None, help='the directory of the model files; next to the pickles by default')
+
+    args = parser.parse_args()
+    params = vars(args)
+    main(params)
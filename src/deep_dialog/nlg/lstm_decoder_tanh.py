@@ -195,7 +195,7 @@ class lstm_decoder_tanh(decoder):
             
         return pred_y, pred_words
     
-    """ Forward pass on prediction with Beam Search """
+    """ Forward pass on prediction with Beam Search: the live beams are expanded together as one (beam, d) state """
     def beam_forward(self, dict, Xs, params, **kwargs):
         max_len = params.get('max_len', 30)
         feed_recurrence = params.get('feed_recurrence', 0)
@@ -237,77 +237,79 @@ class lstm_decoder_tanh(decoder):
         Cellout[0] = np.tanh(Cellin[0])
         Hout[0] = IFOGf[0, 2*d:3*d] * Cellout[0]
         
-        # keep a beam here
-        beams = [] 
-        
         Y = Hout.dot(Wd) + bd
         maxes = np.amax(Y, axis=1, keepdims=True)
         e = np.exp(Y - maxes) # for numerical stability shift into good numerical range
         probs = e/np.sum(e, axis=1, keepdims=True)
         
-        # add beam search here
+        # keep the beams as arrays: log prob, last token, finished flag, hidden and cell state of every beam
         if decoder_sampling == 0: # no sampling
-            beam_candidate_t = (-probs[0]).argsort()[:beam_size]
+            beam_candidate_t = argmaxK(probs, beam_size)[0]
         else:
             beam_candidate_t = np.random.choice(Y.shape[1], beam_size, p=probs[0])
-        #beam_candidate_t = (-probs[0]).argsort()[:beam_size]
-        for ele in beam_candidate_t:
-            beams.append((np.log(probs[0][ele]), [ele], [dict[ele]], Hout[0], Cellin[0]))
         
-        #beams.sort(key=lambda x:x[0], reverse=True)
-        #beams.sort(reverse = True)
+        log_probs = np.log(probs[0][beam_candidate_t])
+        beam_tokens = [[ele] for ele in beam_candidate_t]
+        last_tokens = np.asarray(beam_candidate_t)
+        finished = np.array([dict[ele] == 'e_o_s' for ele in last_tokens])
+        hout = np.tile(Hout[0], (len(beam_tokens), 1))
+        cell = np.tile(Cellin[0], (len(beam_tokens), 1))
+        
+        # the input tokens are one-hot: gather their WLSTM rows instead of multiplying
+        Wb = WLSTM[0]
+        Wx = WLSTM[1:1+xd]
+        Wh = WLSTM[1+xd:]
         
         time_stamp = 0
         while True:
-            beam_candidates = []
-            for b in beams:
-                log_prob = b[0]
-                pred_y_index = b[1][-1]
-                cell_in = b[4]
-                hout_prev = b[3]
+            live = np.flatnonzero(~finished)
+            
+            if len(live) > 0:
+                IFOG = Wb + Wx[last_tokens[live]] + hout[live].dot(Wh)
+                if feed_recurrence == 1: IFOG += Dsh[0]
                 
-                if b[2][-1] == "e_o_s": # this beam predicted end token. Keep in the candidates but don't expand it out any more
-                    beam_candidates.append(b)
-                    continue
-        
-                X = np.zeros(xd)
-                X[pred_y_index] = 1
-                Hin[0,0] = 1 # bias
-                Hin[0,1:1+xd] = X
-                Hin[0, 1+xd:] = hout_prev
+                IFOGf = np.empty(IFOG.shape)
+                IFOGf[:, :3*d] = 1/(1+np.exp(-IFOG[:, :3*d])) # sigmoids; these are three gates
+                IFOGf[:, 3*d:] = np.tanh(IFOG[:, 3*d:]) # tanh for input value
                 
-                IFOG[0] = Hin[0].dot(WLSTM)
-                if feed_recurrence == 1: IFOG[0] += Dsh[0]
-        
-                IFOGf[0, :3*d] = 1/(1+np.exp(-IFOG[0, :3*d])) # sigmoids; these are three gates
-                IFOGf[0, 3*d:] = np.tanh(IFOG[0, 3*d:]) # tanh for input value
-            
-                C = IFOGf[0, :d]*IFOGf[0, 3*d:]
-                cell_in = C + IFOGf[0, d:2*d]*cell_in
-                cell_out = np.tanh(cell_in)
-                hout_prev = IFOGf[0, 2*d:3*d]*cell_out
+                cell[live] = IFOGf[:, :d]*IFOGf[:, 3*d:] + IFOGf[:, d:2*d]*cell[live]
+                hout[live] = IFOGf[:, 2*d:3*d]*np.tanh(cell[live])
                 
-                Y = hout_prev.dot(Wd) + bd
+                Y = hout[live].dot(Wd) + bd
                 maxes = np.amax(Y, axis=1, keepdims=True)
                 e = np.exp(Y - maxes) # for numerical stability shift into good numerical range
                 probs = e/np.sum(e, axis=1, keepdims=True)
                 
                 if decoder_sampling == 0: # no sampling
-                    beam_candidate_t = (-probs[0]).argsort()[:beam_size]
+                    children = argmaxK(probs, beam_size)
                 else:
-                    beam_candidate_t = np.random.choice(Y.shape[1], beam_size, p=probs[0])
-                #beam_candidate_t = (-probs[0]).argsort()[:beam_size]
-                for ele in beam_candidate_t:
-                    beam_candidates.append((log_prob+np.log(probs[0][ele]), np.append(b[1], ele), np.append(b[2], dict[ele]), hout_prev, cell_in))
+                    children = np.array([np.random.choice(Y.shape[1], beam_size, p=p) for p in probs])
+                child_log_probs = log_probs[live][:, None] + np.log(probs[np.arange(len(live))[:, None], children])
+            
+            # candidates in beam order: a finished beam is kept as is, a live beam is replaced by its children
+            counts = np.where(finished, 1, children.shape[1] if len(live) > 0 else 0)
+            parents = np.repeat(np.arange(len(beam_tokens)), counts)
+            expanded = ~finished[parents]
+            candidate_log_probs = log_probs[parents]
+            candidate_tokens = last_tokens[parents]
+            if len(live) > 0:
+                candidate_log_probs[expanded] = child_log_probs.ravel()
+                candidate_tokens[expanded] = children.ravel()
             
-            beam_candidates.sort(key=lambda x:x[0], reverse=True)
-            #beam_candidates.sort(reverse = True) # decreasing order
-            beams = beam_candidates[:beam_size]
+            selected = np.argsort(-candidate_log_probs, kind='mergesort')[:beam_size] # stable, as the list sort
+            parents = parents[selected]
+            beam_tokens = [beam_tokens[p] + [t] if expanded[i] else beam_tokens[p] for i, p, t in zip(selected, parents, candidate_tokens[selected])]
+            log_probs = candidate_log_probs[selected]
+            last_tokens = candidate_tokens[selected]
+            finished = np.array([dict[ele] == 'e_o_s' for ele in last_tokens])
+            hout = hout[parents]
+            cell = cell[parents]
             time_stamp += 1
-
-            if time_stamp >= max_len: break
+            
+            # finished beams are never expanded again: once all are finished the beams cannot change
+            if time_stamp >= max_len or finished.all(): break
         
-        return beams[0][1], beams[0][2]
+        return beam_tokens[0], [dict[ele] for ele in beam_tokens[0]]
     
     """ Backward Pass """
     def bwdPass(self, dY, cache):
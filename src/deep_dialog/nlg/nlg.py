@@ -12,12 +12,20 @@ import copy, argparse, json
 import numpy as np
 
 from deep_dialog import dialog_config
+from deep_dialog.lru_cache import LRUCache
+from deep_dialog.model_file import load_model_file
 from deep_dialog.nlg.lstm_decoder_tanh import lstm_decoder_tanh
 
 
 class nlg:
     def __init__(self):
-        pass
+        self.template_index = {}
+        self.sentence_cache = LRUCache(max_entries=dialog_config.nlg_cache_size) if dialog_config.nlg_cache_size > 0 else None
+    
+    def template_key(self, diaact, inform_slots, request_slots):
+        """ The key of the pre-defined Dia_Act&NL pairs: dia_act and the sets of inform and request slots """
+        
+        return (diaact, frozenset(inform_slots), frozenset(request_slots))
     
     def post_process(self, pred_template, slot_val_dict, slot_dict):
         """ post_process to fill the slot in the template sentence """
@@ -59,12 +67,10 @@ class nlg:
             for slot in inform_slot_set:
                 if dia_act['inform_slots'][slot] == dialog_config.I_DO_NOT_CARE: del dia_act['inform_slots'][slot]
         
-        if dia_act['diaact'] in self.diaact_nl_pairs['dia_acts'].keys():
-            for ele in self.diaact_nl_pairs['dia_acts'][dia_act['diaact']]:
-                if set(ele['inform_slots']) == set(dia_act['inform_slots'].keys()) and set(ele['request_slots']) == set(dia_act['request_slots'].keys()):
-                    sentence = self.diaact_to_nl_slot_filling(dia_act, ele['nl'][turn_msg])
-                    boolean_in = True
-                    break
+        ele = self.template_index.get(self.template_key(dia_act['diaact'], dia_act['inform_slots'].keys(), dia_act['request_slots'].keys()))
+        if ele is not None:
+            sentence = self.diaact_to_nl_slot_filling(dia_act, ele['nl'][turn_msg])
+            boolean_in = True
         
         if dia_act['diaact'] == 'inform' and 'taskcomplete' in dia_act['inform_slots'].keys() and dia_act['inform_slots']['taskcomplete'] == dialog_config.NO_VALUE_MATCH:
             sentence = "Oh sorry, there is no ticket available."
@@ -124,18 +130,24 @@ class nlg:
         dia_act_rep['diaact'] = final_representation
         dia_act_rep['words'] = words
     
-        #pred_ys, pred_words = nlg_model['model'].forward(inverse_word_dict, dia_act_rep, nlg_model['params'], predict_model=True)
-        pred_ys, pred_words = self.model.beam_forward(inverse_word_dict, dia_act_rep, self.params, predict_model=True)
-        pred_sentence = ' '.join(pred_words[:-1])
+        # the model only sees the delexicalized dia_act: memoize its (deterministic) sentence on that representation
+        memoize = self.sentence_cache is not None and self.params.get('decoder_sampling', 0) == 0
+        cache_key = tuple(np.flatnonzero(final_representation))
+        pred_sentence = self.sentence_cache.get(cache_key) if memoize else None
+        if pred_sentence is None:
+            #pred_ys, pred_words = nlg_model['model'].forward(inverse_word_dict, dia_act_rep, nlg_model['params'], predict_model=True)
+            pred_ys, pred_words = self.model.beam_forward(inverse_word_dict, dia_act_rep, self.params, predict_model=True)
+            pred_sentence = ' '.join(pred_words[:-1])
+            if memoize: self.sentence_cache.put(cache_key, pred_sentence)
         sentence = self.post_process(pred_sentence, dia_act['inform_slots'], slot_dict)
             
         return sentence
     
     
     def load_nlg_model(self, model_path):
-        """ load the trained NLG model """  
+        """ load the trained NLG model (a model file or a pickle, see deep_dialog/model_file.py) """  
         
-        model_params = pickle.load(open(model_path, 'rb'))
+        model_params = load_model_file(model_path)
 
         hidden_size = model_params['model']['Wd'].shape[0]
         output_size = model_params['model']['Wd'].shape[1]
@@ -145,16 +157,17 @@ class nlg:
             input_size = model_params['model']['WLSTM'].shape[0] - hidden_size - 1
             rnnmodel = lstm_decoder_tanh(diaact_input_size, input_size, hidden_size, output_size)
         
-        rnnmodel.model = copy.deepcopy(model_params['model'])
+        rnnmodel.model = model_params['model']
+        if self.sentence_cache is not None: self.sentence_cache.clear()
         model_params['params']['beam_size'] = dialog_config.nlg_beam_size
         
         self.model = rnnmodel
-        self.word_dict = copy.deepcopy(model_params['word_dict'])
-        self.template_word_dict = copy.deepcopy(model_params['template_word_dict'])
-        self.slot_dict = copy.deepcopy(model_params['slot_dict'])
-        self.act_dict = copy.deepcopy(model_params['act_dict'])
+        self.word_dict = model_params['word_dict']
+        self.template_word_dict = model_params['template_word_dict']
+        self.slot_dict = model_params['slot_dict']
+        self.act_dict = model_params['act_dict']
         self.inverse_word_dict = {self.template_word_dict[k]:k for k in self.template_word_dict.keys()}
-        self.params = copy.deepcopy(model_params['params'])
+        self.params = model_params['params']
         
     
     def diaact_to_nl_slot_filling(self, dia_act, template_sentence):
@@ -193,11 +206,15 @@ class nlg:
         """ Load some pre-defined Dia_Act&NL Pairs from file """
         
         self.diaact_nl_pairs = json.load(open(path, 'rb'))
+        self.template_index = {}
         
         for key in self.diaact_nl_pairs['dia_acts'].keys():
             for ele in self.diaact_nl_pairs['dia_acts'][key]:
                 ele['nl']['usr'] = ele['nl']['usr'].encode('utf-8') # encode issue
                 ele['nl']['agt'] = ele['nl']['agt'].encode('utf-8') # encode issue
+                
+                # the first pair of a (dia_act, inform slots, request slots) key wins, as in a linear scan
+                self.template_index.setdefault(self.template_key(key, ele['inform_slots'], ele['request_slots']), ele)
 
 
 def main(params):
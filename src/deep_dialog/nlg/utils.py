@@ -18,4 +18,12 @@ def mergeDicts(d0, d1):
     """ for all k in d0, d0 += d1 . d's are dictionaries of key -> numpy array """
     for k in d1:
         if k in d0: d0[k] += d1[k]
-        else: d0[k] = d1[k]
\ No newline at end of file
+        else: d0[k] = d1[k]
+
+def argmaxK(scores, k):
+    """ Indices of the k largest entries of each row of scores (2-d), in decreasing order """
+    k = min(k, scores.shape[1])
+    rows = np.arange(scores.shape[0])[:, None]
+    top = np.argpartition(-scores, k-1, axis=1)[:, :k]
+    order = np.argsort(-scores[rows, top], axis=1, kind='mergesort')
+    return top[rows, order]
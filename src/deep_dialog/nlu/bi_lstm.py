@@ -126,6 +126,56 @@ class biLSTM(SeqToSeq):
             
         return Y, cache
     
+    """ Forward pass on token ids: the input projections of every timestep are row gathers of WLSTM and bWLSTM, only the recurrences are multiplied per step """
+    def fwdPassIndices(self, word_ids, params, **kwargs):
+        Ys, cache = self.fwdPassIndicesBatch(np.asarray(word_ids, dtype=int)[None, :], params, **kwargs)
+        return Ys[0], cache
+    
+    """ Forward pass on a (batch, n) matrix of token ids (sequences of the same length), returns (batch, n, output_size) """
+    def fwdPassIndicesBatch(self, word_ids, params, **kwargs):
+        WLSTM = self.model['WLSTM']
+        bWLSTM = self.model['bWLSTM']
+        d = self.model['Wd'].shape[0] # size of hidden layer
+        xd = WLSTM.shape[0] - d - 1
+        b, n = word_ids.shape
+        
+        rows = 1 + word_ids
+        Xh = WLSTM[0] + WLSTM[rows] # bias + x_t rows, for all t: (b, n, 4d)
+        bXh = bWLSTM[0] + bWLSTM[rows]
+        Wh = WLSTM[1+xd:]
+        bWh = bWLSTM[1+xd:]
+        
+        Hout = np.zeros((b, n, d))
+        Cellin = np.zeros((b, n, d))
+        bHout = np.zeros((b, n, d))
+        bCellin = np.zeros((b, n, d))
+        
+        for t in xrange(n):
+            IFOG = Xh[:, t] + Hout[:, t-1].dot(Wh) if t > 0 else Xh[:, t]
+            
+            IFOGf = np.empty((b, 4*d))
+            IFOGf[:, :3*d] = 1/(1+np.exp(-IFOG[:, :3*d])) # sigmoids; these are three gates
+            IFOGf[:, 3*d:] = np.tanh(IFOG[:, 3*d:]) # tanh for input value
+            
+            Cellin[:, t] = IFOGf[:, :d] * IFOGf[:, 3*d:]
+            if t>0: Cellin[:, t] += IFOGf[:, d:2*d]*Cellin[:, t-1]
+            Hout[:, t] = IFOGf[:, 2*d:3*d] * np.tanh(Cellin[:, t])
+            
+            # backward hidden layer
+            b_t = n-1-t
+            bIFOG = bXh[:, b_t] + bHout[:, b_t+1].dot(bWh) if t > 0 else bXh[:, b_t]
+            
+            bIFOGf = np.empty((b, 4*d))
+            bIFOGf[:, :3*d] = 1/(1+np.exp(-bIFOG[:, :3*d]))
+            bIFOGf[:, 3*d:] = np.tanh(bIFOG[:, 3*d:])
+            
+            bCellin[:, b_t] = bIFOGf[:, :d] * bIFOGf[:, 3*d:]
+            if t>0: bCellin[:, b_t] += bIFOGf[:, d:2*d] * bCellin[:, b_t+1]
+            bHout[:, b_t] = bIFOGf[:, 2*d:3*d] * np.tanh(bCellin[:, b_t])
+        
+        Y = Hout.dot(self.model['Wd']) + self.model['bd'] + bHout.dot(self.model['bWd']) + self.model['bbd']
+        return Y, {}
+    
     """ Backward Pass """
     def bwdPass(self, dY, cache):
         Wd = cache['Wd']
@@ -79,6 +79,39 @@ class lstm(SeqToSeq):
             
         return Y, cache
     
+    """ Forward pass on token ids: the input projection of every timestep is a row gather of WLSTM, only the recurrence is multiplied per step """
+    def fwdPassIndices(self, word_ids, params, **kwargs):
+        Ys, cache = self.fwdPassIndicesBatch(np.asarray(word_ids, dtype=int)[None, :], params, **kwargs)
+        return Ys[0], cache
+    
+    """ Forward pass on a (batch, n) matrix of token ids (sequences of the same length), returns (batch, n, output_size) """
+    def fwdPassIndicesBatch(self, word_ids, params, **kwargs):
+        WLSTM = self.model['WLSTM']
+        d = self.model['Wd'].shape[0] # size of hidden layer
+        xd = WLSTM.shape[0] - d - 1
+        b, n = word_ids.shape
+        
+        Xh = WLSTM[0] + WLSTM[1 + word_ids] # bias + x_t rows, for all t: (b, n, 4d)
+        Wh = WLSTM[1+xd:]
+        
+        Hout = np.zeros((b, n, d))
+        Cellin = np.zeros((b, n, d))
+        
+        for t in xrange(n):
+            IFOG = Xh[:, t] + Hout[:, t-1].dot(Wh) if t > 0 else Xh[:, t]
+            
+            IFOGf = np.empty((b, 4*d))
+            IFOGf[:, :3*d] = 1/(1+np.exp(-IFOG[:, :3*d])) # sigmoids; these are three gates
+            IFOGf[:, 3*d:] = np.tanh(IFOG[:, 3*d:]) # tanh for input value
+            
+            Cellin[:, t] = IFOGf[:, :d] * IFOGf[:, 3*d:]
+            if t>0: Cellin[:, t] += IFOGf[:, d:2*d]*Cellin[:, t-1]
+            
+            Hout[:, t] = IFOGf[:, 2*d:3*d] * np.tanh(Cellin[:, t])
+        
+        Y = Hout.dot(self.model['Wd']) + self.model['bd']
+        return Y, {}
+    
     """ Backward Pass """
     def bwdPass(self, dY, cache):
         Wd = cache['Wd']
@@ -8,6 +8,7 @@ import cPickle as pickle
 import copy
 import numpy as np
 
+from deep_dialog.model_file import load_model_file
 from lstm import lstm
 from bi_lstm import biLSTM
 
@@ -19,35 +20,51 @@ class nlu:
     def generate_dia_act(self, annot):
         """ generate the Dia-Act with NLU model """
         
-        if len(annot) > 0:
-            tmp_annot = annot.strip('.').strip('?').strip(',').strip('!') 
-            
-            rep = self.parse_str_to_vector(tmp_annot)
-            Ys, cache = self.model.fwdPass(rep, self.params, predict_model=True) # default: True
-            
-            maxes = np.amax(Ys, axis=1, keepdims=True)
-            e = np.exp(Ys - maxes) # for numerical stability shift into good numerical range
-            probs = e/np.sum(e, axis=1, keepdims=True)
-            if np.all(np.isnan(probs)): probs = np.zeros(probs.shape)
-            
-            # special handling with intent label
-            for tag_id in self.inverse_tag_dict.keys():
-                if self.inverse_tag_dict[tag_id].startswith('B-') or self.inverse_tag_dict[tag_id].startswith('I-') or self.inverse_tag_dict[tag_id] == 'O':
-                    probs[-1][tag_id] = 0
-            
-            pred_words_indices = np.nanargmax(probs, axis=1)
-            pred_tags = [self.inverse_tag_dict[index] for index in pred_words_indices]
-            
-            diaact = self.parse_nlu_to_diaact(pred_tags, tmp_annot)
-            return diaact
-        else:
-            return None
+        return self.generate_dia_acts([annot])[0]
+    
+    def generate_dia_acts(self, annots):
+        """ generate the Dia-Acts of a list of utterances: the utterances of the same length are tagged in one batch """
+        
+        dia_acts = [None] * len(annots)
+        buckets = {}
+        for i, annot in enumerate(annots):
+            if len(annot) > 0:
+                tmp_annot = annot.strip('.').strip('?').strip(',').strip('!') 
+                
+                rep = self.parse_str_to_indices(tmp_annot)
+                buckets.setdefault(len(rep['word_ids']), []).append((i, tmp_annot, rep['word_ids']))
+        
+        for length in sorted(buckets.keys()):
+            bucket = buckets[length]
+            Ys, cache = self.model.fwdPassIndicesBatch(np.array([word_ids for (i, tmp_annot, word_ids) in bucket]), self.params)
+            for (i, tmp_annot, word_ids), Y in zip(bucket, Ys):
+                dia_acts[i] = self.decode_dia_act(Y, tmp_annot)
+        return dia_acts
+    
+    def decode_dia_act(self, Ys, tmp_annot):
+        """ decode the BIO tags and the intent predicted for an utterance into its Dia-Act """
+        
+        maxes = np.amax(Ys, axis=1, keepdims=True)
+        e = np.exp(Ys - maxes) # for numerical stability shift into good numerical range
+        probs = e/np.sum(e, axis=1, keepdims=True)
+        if np.all(np.isnan(probs)): probs = np.zeros(probs.shape)
+        
+        # special handling with intent label
+        for tag_id in self.inverse_tag_dict.keys():
+            if self.inverse_tag_dict[tag_id].startswith('B-') or self.inverse_tag_dict[tag_id].startswith('I-') or self.inverse_tag_dict[tag_id] == 'O':
+                probs[-1][tag_id] = 0
+        
+        pred_words_indices = np.nanargmax(probs, axis=1)
+        pred_tags = [self.inverse_tag_dict[index] for index in pred_words_indices]
+        
+        diaact = self.parse_nlu_to_diaact(pred_tags, tmp_annot)
+        return diaact
 
     
     def load_nlu_model(self, model_path):
-        """ load the trained NLU model """  
+        """ load the trained NLU model (a model file or a pickle, see deep_dialog/model_file.py) """  
         
-        model_params = pickle.load(open(model_path, 'rb'))
+        model_params = load_model_file(model_path)
     
         hidden_size = model_params['model']['Wd'].shape[0]
         output_size = model_params['model']['Wd'].shape[1]
@@ -59,34 +76,44 @@ class nlu:
             input_size = model_params['model']['WLSTM'].shape[0] - hidden_size - 1
             rnnmodel = biLSTM(input_size, hidden_size, output_size)
            
-        rnnmodel.model = copy.deepcopy(model_params['model'])
+        rnnmodel.model = model_params['model']
         
         self.model = rnnmodel
-        self.word_dict = copy.deepcopy(model_params['word_dict'])
-        self.slot_dict = copy.deepcopy(model_params['slot_dict'])
-        self.act_dict = copy.deepcopy(model_params['act_dict'])
-        self.tag_set = copy.deepcopy(model_params['tag_set'])
-        self.params = copy.deepcopy(model_params['params'])
+        self.word_dict = model_params['word_dict']
+        self.slot_dict = model_params['slot_dict']
+        self.act_dict = model_params['act_dict']
+        self.tag_set = model_params['tag_set']
+        self.params = model_params['params']
         self.inverse_tag_dict = {self.tag_set[k]:k for k in self.tag_set.keys()}
         
            
-    def parse_str_to_vector(self, string):
-        """ Parse string into vector representations """
+    def parse_str_to_indices(self, string):
+        """ Parse string into the word index sequence """
         
         tmp = 'BOS ' + string + ' EOS'
         words = tmp.lower().split(' ')
         
-        vecs = np.zeros((len(words), len(self.word_dict)))
-        for w_index, w in enumerate(words):
+        unk = self.word_dict['unk']
+        word_ids = []
+        for w in words:
             if w.endswith(',') or w.endswith('?'): w = w[0:-1]
-            if w in self.word_dict.keys():
-                vecs[w_index][self.word_dict[w]] = 1
-            else: vecs[w_index][self.word_dict['unk']] = 1
+            word_ids.append(self.word_dict.get(w, unk))
         
         rep = {}
-        rep['word_vectors'] = vecs
+        rep['word_ids'] = np.array(word_ids, dtype=int)
         rep['raw_seq'] = string
         return rep
+    
+    def parse_str_to_vector(self, string):
+        """ Parse string into vector representations """
+        
+        rep = self.parse_str_to_indices(string)
+        
+        vecs = np.zeros((len(rep['word_ids']), len(self.word_dict)))
+        vecs[np.arange(len(rep['word_ids'])), rep['word_ids']] = 1
+        
+        rep['word_vectors'] = vecs
+        return rep
 
     def parse_nlu_to_diaact(self, nlu_vector, string):
         """ Parse BIO and Intent into Dia-Act """
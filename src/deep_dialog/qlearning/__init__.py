@@ -1,2 +1,4 @@
 from .utils import *
-from .dqn import *
\ No newline at end of file
+from .dqn import *
+from .replay_buffer import *
+from .checkpoint_writer import *
\ No newline at end of file
@@ -0,0 +1,124 @@
+'''
+Checkpoint files written off the training loop
+
+- Checkpoints (pickles or model files) and performance records (JSON) are queued and serialized by a background thread;
+  the queue is bounded, so training only waits when the disk falls behind by more than max_pending files
+- Every file is written to a temporary file next to it and renamed over it: a crash never leaves a truncated file
+- Optionally only the keep_last newest checkpoints written by the writer are kept
+
+'''
+
+import os
+import json
+import atexit
+import tempfile
+import threading
+import Queue
+import cPickle as pickle
+
+from deep_dialog.model_file import dump_model
+
+
+class CheckpointWriter:
+
+    def __init__(self, max_pending=4, keep_last=0):
+        """ Constructor for a CheckpointWriter
+
+        Arguments:
+        max_pending     --  The number of files queued before save_* blocks; 0 writes them synchronously
+        keep_last       --  The number of newest checkpoints (save_pickle, save_model_file) kept on disk, older ones are deleted; 0 keeps all
+
+        The objects handed to save_* are serialized later: they must not be modified afterwards.
+        """
+
+        self.max_pending = max_pending
+        self.keep_last = keep_last
+        self.checkpoints = [] # the checkpoint paths written, oldest first
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self.queue = None
+        self.thread = None
+
+    def save_pickle(self, path, obj):
+        """ Pickle obj to path (a checkpoint) """
+        self.submit(path, obj, pickle.dump, True)
+
+    def save_model_file(self, path, obj):
+        """ Write the model dictionary obj to path as a model file (a checkpoint, see deep_dialog/model_file.py) """
+        self.submit(path, obj, dump_model, True)
+
+    def save_json(self, path, obj):
+        """ Write obj to path as JSON """
+        self.submit(path, obj, json.dump, False)
+
+    def submit(self, path, obj, dump, is_checkpoint):
+        if self.max_pending <= 0:
+            self.write(path, obj, dump, is_checkpoint)
+            return
+        if self.thread is None: # started on the first file, so that processes forked earlier do not inherit it
+            self.queue = Queue.Queue(self.max_pending)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.close)
+        self.queue.put((path, obj, dump, is_checkpoint))
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            self.write(*task)
+
+    def write(self, path, obj, dump, is_checkpoint):
+        """ Write obj to path atomically (temporary file, then rename) """
+
+        directory, filename = os.path.split(os.path.abspath(path))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + filename + '.', suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                dump(obj, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0666 & ~self.umask) # mkstemp creates it 0600, open() would have used the umask
+            try:
+                os.rename(tmp_path, path)
+            except OSError: # Windows does not rename over an existing file
+                os.remove(path)
+                os.rename(tmp_path, path)
+            tmp_path = None
+            print 'saved model in %s' % (path, )
+        except Exception, e:
+            print 'Error: Writing model fails: %s' % (path, )
+            print e
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if is_checkpoint:
+            self.rotate(path)
+
+    def rotate(self, path):
+        """ Record checkpoint path, delete the checkpoints beyond the keep_last newest ones """
+
+        if path in self.checkpoints:
+            self.checkpoints.remove(path)
+        self.checkpoints.append(path)
+        if self.keep_last <= 0:
+            return
+        while len(self.checkpoints) > self.keep_last:
+            old_path = self.checkpoints.pop(0)
+            try:
+                os.remove(old_path)
+            except OSError, e:
+                print 'Error: Removing old checkpoint fails: %s' % (old_path, )
+                print e
+
+    def close(self):
+        """ Write the queued files and stop the thread """
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
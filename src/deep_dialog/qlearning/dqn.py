@@ -4,6 +4,8 @@ Created on Jun 18, 2016
 @author: xiul
 '''
 
+import copy
+
 from .utils import *
 
 
@@ -23,7 +25,57 @@ class DQN:
         self.regularize = ['Wxh', 'Wd']
 
         self.step_cache = {}
+        self.pack()
+        
+    
+    """ Weight snapshots: the matrices of self.model are views of one flat buffer, self.weights """
+    def pack(self):
+        """ Move the matrices of self.model into a new flat buffer, in self.update order """
+        
+        self.layout = []
+        size = 0
+        for name in self.update:
+            self.layout.append((name, size, self.model[name].shape))
+            size += self.model[name].size
+        
+        self.weights = np.empty(size, dtype=np.result_type(*[self.model[name] for name in self.update]))
+        for name, start, shape in self.layout:
+            view = self.weights[start:start + int(np.prod(shape))].reshape(shape)
+            view[...] = self.model[name]
+            self.model[name] = view
+    
+    def set_model(self, model):
+        """ Use the weights of a model dictionary (e.g. a saved one); its matrices are copied """
+        
+        self.model = dict(model)
+        self.pack()
+    
+    def snapshot(self, out=None):
+        """ A copy of the weights as one flat array, written into out (an earlier snapshot) when given """
+        
+        if out is None:
+            return self.weights.copy()
+        np.copyto(out, self.weights)
+        return out
+    
+    def load_snapshot(self, snapshot):
+        """ Copy the weights of a snapshot (see snapshot) back into the model, in place """
         
+        np.copyto(self.weights, snapshot)
+    
+    def snapshot_model(self, snapshot):
+        """ The model dictionary (name -> matrix) of a snapshot, as views of it """
+        
+        return dict((name, snapshot[start:start + int(np.prod(shape))].reshape(shape)) for name, start, shape in self.layout)
+    
+    def __deepcopy__(self, memo):
+        other = copy.copy(self)
+        other.update = list(self.update)
+        other.regularize = list(self.regularize)
+        other.step_cache = copy.deepcopy(self.step_cache, memo)
+        other.set_model(self.model)
+        return other
+    
 
     def getStruct(self):
         return {'model': self.model, 'update': self.update, 'regularize': self.regularize}
@@ -130,41 +182,21 @@ class DQN:
         return Ys, cache
     
     def batchDoubleForward(self, batch, params, clone_dqn, predict_mode = False):
-        caches = []
-        Ys = []
-        tYs = []
+        """ Run one forward pass of the (B, state_dim) state matrices through each network """
+        
+        states, _, _, next_states, _ = batch
+        Ys, cache = self.fwdPass(states, params, predict_mode = predict_mode)
+        tYs, _ = clone_dqn.fwdPass(next_states, params, predict_mode = True)
         
-        for i,x in enumerate(batch):
-            Xs = x[0]
-            Y, out_cache = self.fwdPass(Xs, params, predict_mode = predict_mode)
-            caches.append(out_cache)
-            Ys.append(Y)
-            
-            tXs = x[3]
-            tY, t_cache = clone_dqn.fwdPass(tXs, params, predict_mode = False)
-                
-            tYs.append(tY)
-            
-        # back up information for efficient backprop
-        cache = {}
-        if not predict_mode:
-            cache['caches'] = caches
-
         return Ys, cache, tYs
     
     def batchBackward(self, dY, cache):
-        caches = cache['caches']
+        """ Backprop the (B, output_size) error matrix in one pass; gradients are summed over the batch """
         
-        grads = {}
-        for i in xrange(len(caches)):
-            single_cache = caches[i]
-            local_grads = self.bwdPass(dY[i], single_cache)
-            mergeDicts(grads, local_grads) # add up the gradients wrt model parameters
-            
-        return grads
+        return self.bwdPass(dY, cache)
 
 
-    """ cost function, returns cost and gradients for model """
+    """ cost function, returns cost and gradients for model; batch is (states, actions, rewards, next_states, dones) """
     def costFunc(self, batch, params, clone_dqn):
         regc = params.get('reg_cost', 1e-3)
         gamma = params.get('gamma', 0.9)
@@ -172,37 +204,22 @@ class DQN:
         # batch forward
         Ys, caches, tYs = self.batchDoubleForward(batch, params, clone_dqn, predict_mode = False)
         
-        loss_cost = 0.0
-        dYs = []
-        for i,x in enumerate(batch):
-            Y = Ys[i]
-            nY = tYs[i]
-            
-            action = np.array(x[1], dtype=int)
-            reward = np.array(x[2], dtype=float)
-            
-            n_action = np.nanargmax(nY[0])
-            max_next_y = nY[0][n_action]
-            
-            eposide_terminate = x[4]
-            
-            target_y = reward
-            if eposide_terminate != True: target_y += gamma*max_next_y
-            
-            pred_y = Y[0][action]
-            
-            nY = np.zeros(nY.shape)
-            nY[0][action] = target_y
-            Y = np.zeros(Y.shape)
-            Y[0][action] = pred_y
-            
-            # Cost Function
-            loss_cost += (target_y - pred_y)**2
-                
-            dY = -(nY - Y)
-            #dY = np.minimum(dY, 1)
-            #dY = np.maximum(dY, -1)
-            dYs.append(dY)
+        _, actions, rewards, _, dones = batch
+        batch_size = len(actions)
+        rows = np.arange(batch_size)
+        not_terminate = 1.0 - dones
+        
+        max_next_y = np.nanmax(tYs, axis=1)
+        target_y = rewards + gamma*max_next_y*not_terminate
+        pred_y = Ys[rows, actions]
+        
+        # Cost Function
+        loss_cost = np.sum((target_y - pred_y)**2)
+        
+        dYs = np.zeros(Ys.shape)
+        dYs[rows, actions] = -(target_y - pred_y)
+        #dYs = np.minimum(dYs, 1)
+        #dYs = np.maximum(dYs, -1)
         
         # backprop the RNN
         grads = self.batchBackward(dYs, caches)
@@ -216,7 +233,6 @@ class DQN:
                 grads[p] += regc*mat
 
         # normalize the cost and gradient by the batch size
-        batch_size = len(batch)
         reg_cost /= batch_size
         loss_cost /= batch_size
         for k in grads: grads[k] /= batch_size
@@ -282,3 +298,8 @@ class DQN:
         pred_action = np.argmax(Ys)
         
         return pred_action
+    
+    """ batch prediction: one forward pass for a (B, input_size) matrix, returns the argmax action of each row """
+    def predict_batch(self, Xs, params, **kwargs):
+        Ys, caches = self.fwdPass(Xs, params, predict_mode=True)
+        return np.argmax(Ys, axis=1)
@@ -0,0 +1,115 @@
+'''
+A columnar experience replay buffer for the DQN agent
+
+- States, next states, actions, rewards and done flags are kept in preallocated arrays
+- Appending writes one row in place; when full the buffer either grows or evicts the oldest transition
+- Sampling returns ready-made batch matrices: (states, actions, rewards, next_states, dones)
+
+'''
+
+import numpy as np
+
+
+class ReplayBuffer:
+
+    def __init__(self, state_dimension, size=1000, max_size=None, dtype=np.float32):
+        """ Constructor for the ReplayBuffer
+
+        Arguments:
+        state_dimension     --  The dimension of a single state representation
+        size                --  The number of transitions to preallocate
+        max_size            --  The hard capacity; once reached the oldest transition is overwritten (ring buffer).
+                                None keeps every transition (the buffer doubles whenever it is full)
+        dtype               --  The storage type of the state matrices
+        """
+
+        self.state_dimension = state_dimension
+        self.max_size = max_size
+        self.dtype = dtype
+
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        self.allocate(max(size, 1))
+
+    def allocate(self, capacity):
+        """ Allocate empty storage for capacity transitions """
+
+        self.capacity = capacity
+        self.states = np.zeros((capacity, self.state_dimension), dtype=self.dtype)
+        self.next_states = np.zeros((capacity, self.state_dimension), dtype=self.dtype)
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.bool_)
+        self.cursor = 0
+        self.count = 0
+
+    def grow(self, capacity):
+        """ Reallocate storage to capacity, keeping the stored transitions (in insertion order) """
+
+        order = self.ordered_indices()
+        columns = [c[order] for c in (self.states, self.next_states, self.actions, self.rewards, self.dones)]
+        count = self.count
+
+        self.allocate(capacity)
+        for dst, src in zip((self.states, self.next_states, self.actions, self.rewards, self.dones), columns):
+            dst[:count] = src
+        self.count = count
+        self.cursor = count % capacity
+
+    def ordered_indices(self):
+        """ Row indices of the stored transitions from the oldest to the newest """
+
+        if self.count < self.capacity:
+            return np.arange(self.count)
+        return (np.arange(self.capacity) + self.cursor) % self.capacity
+
+    def __len__(self):
+        return self.count
+
+    def append(self, state_t_rep, action_t, reward_t, state_tplus1_rep, episode_over):
+        """ Store one transition <s_t, a_t, r_t, s_t+1, episode_over> """
+
+        if self.count == self.capacity and (self.max_size is None or self.capacity < self.max_size):
+            new_capacity = 2 * self.capacity
+            if self.max_size is not None:
+                new_capacity = min(new_capacity, self.max_size)
+            self.grow(new_capacity)
+
+        i = self.cursor
+        self.states[i] = state_t_rep.ravel()
+        self.next_states[i] = state_tplus1_rep.ravel()
+        self.actions[i] = action_t
+        self.rewards[i] = reward_t
+        self.dones[i] = episode_over == True
+
+        self.cursor = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def extend(self, transitions):
+        """ Store a sequence of (s_t, a_t, r_t, s_t+1, episode_over) tuples """
+
+        for transition in transitions:
+            self.append(*transition)
+
+    def clear(self):
+        """ Drop every stored transition, keeping the allocated storage """
+
+        self.cursor = 0
+        self.count = 0
+
+    def sample(self, batch_size):
+        """ Sample batch_size transitions uniformly with replacement, returned as batch matrices """
+
+        idx = np.random.randint(0, self.count, size=batch_size)
+        return self.batch(idx)
+
+    def batch(self, idx):
+        """ Gather the transitions at row indices idx into (states, actions, rewards, next_states, dones) """
+
+        return (self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx], self.dones[idx])
+
+    def transitions(self):
+        """ Return the stored transitions as a list of (s_t, a_t, r_t, s_t+1, episode_over) tuples """
+
+        return [(self.states[i:i+1], int(self.actions[i]), float(self.rewards[i]), self.next_states[i:i+1], bool(self.dones[i]))
+                for i in self.ordered_indices()]
@@ -2,4 +2,5 @@ from .usersim_rule import *
 from .action_generation import *
 from .nn_models import *
 from .usersim_supervise import *
-from .prepare_data import *
\ No newline at end of file
+from .prepare_data import *
+from .inference_server import *
\ No newline at end of file
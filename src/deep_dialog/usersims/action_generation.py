@@ -18,6 +18,8 @@ import argparse
 import logging
 import numpy as np
 import sys
+import threading
+import Queue
 
 from nn_models import MultiLableClassifyLayer, LSTM_MultiLabelClassifier, Seq2SeqActionGenerator, State2Seq
 from prepare_data import *
@@ -67,27 +69,39 @@ def get_f1(pred_tags_lst, golden_tags_lst):
     """
     tp, fp, fn = 0, 0, 0
     # print(len(pred_tags_lst), len(pred_tags_lst[0]), golden_tags_lst.shape)
-    for pred_tags, golden_tags in zip(pred_tags_lst, golden_tags_lst):
-        if len(pred_tags) != len(golden_tags):
-            logging.error('Unmatched tags: \npred:{}{}\ngold:{}{}'.format(
-                len(pred_tags), pred_tags, len(golden_tags), golden_tags)
-            )
+    if isinstance(pred_tags_lst, np.ndarray) and isinstance(golden_tags_lst, np.ndarray):  # multi-hot matrices
+        if pred_tags_lst.shape[1:] != golden_tags_lst.shape[1:]:
+            logging.error('Unmatched tags: \npred:{}\ngold:{}'.format(pred_tags_lst.shape, golden_tags_lst.shape))
             raise RuntimeError
-        for pred_t, gold_t in zip(pred_tags, golden_tags):
-            if pred_t == 1:
-                if pred_t == gold_t:
-                    tp += 1
-                elif gold_t == 0:
-                    fp += 1
-                else:
-                    raise RuntimeError
-            elif pred_t == 0:
-                if pred_t == gold_t:
-                    pass
-                elif gold_t == 1:
-                    fn += 1
-                else:
-                    raise RuntimeError
+        n = min(len(pred_tags_lst), len(golden_tags_lst))
+        pred, gold = pred_tags_lst[:n], golden_tags_lst[:n]
+        if (((pred == 0) | (pred == 1)) & (gold != 0) & (gold != 1)).any():
+            raise RuntimeError
+        tp = int(np.sum((pred == 1) & (gold == 1)))
+        fp = int(np.sum((pred == 1) & (gold == 0)))
+        fn = int(np.sum((pred == 0) & (gold == 1)))
+    else:
+        for pred_tags, golden_tags in zip(pred_tags_lst, golden_tags_lst):
+            if len(pred_tags) != len(golden_tags):
+                logging.error('Unmatched tags: \npred:{}{}\ngold:{}{}'.format(
+                    len(pred_tags), pred_tags, len(golden_tags), golden_tags)
+                )
+                raise RuntimeError
+            for pred_t, gold_t in zip(pred_tags, golden_tags):
+                if pred_t == 1:
+                    if pred_t == gold_t:
+                        tp += 1
+                    elif gold_t == 0:
+                        fp += 1
+                    else:
+                        raise RuntimeError
+                elif pred_t == 0:
+                    if pred_t == gold_t:
+                        pass
+                    elif gold_t == 1:
+                        fn += 1
+                    else:
+                        raise RuntimeError
     if tp == 0:
         precision = 0
         recall = 0
@@ -131,12 +145,8 @@ def gen2vector(pred, id2token, full_dict):
 
 
 def get_f1_from_generation(pred_tags_lst, golden_tags_lst, full_dict):
-    id2token = full_dict['tgt_id2token']
-    # print('========== pred ===========')
-    pred_tags_lst = [gen2vector(tags, id2token, full_dict) for tags in pred_tags_lst]
-    # print('===========  gold ============')
-    golden_tags_lst = [gen2vector(tags, id2token, full_dict) for tags in golden_tags_lst]
-    return get_f1(pred_tags_lst, golden_tags_lst)
+    decoder = ActionDecoder(full_dict, full_dict['tgt_id2token'])
+    return get_f1(decoder.label_matrix(pred_tags_lst), decoder.label_matrix(golden_tags_lst))
 
 
 def vector2state(state_vector, full_dict):
@@ -293,7 +303,106 @@ def vector2action(action_vector, full_dict):
     return ret
 
 
-def eval_model(model, valid_x, valid_y, full_dict, opt):
+class ActionDecoder(object):
+    """
+    gen2vector and vector2action compiled into lookup tables, applied to a whole batch of predictions at once.
+    Tokens are looked up by id: a token id -> field table (which token opens a diaact / inform_slots /
+    request_slots pair) and a (field, token id) -> label column table (-1 for an invalid value of the field).
+    """
+    FIELDS = ['diaact', 'inform_slots', 'request_slots']
+
+    def __init__(self, full_dict, id2token=None):
+        """
+        :param full_dict: the dict built by the data preparation
+        :param id2token: the decoder vocabulary (token id -> token), None to only decode label matrices
+        :return:
+        """
+        item2id_lst = [full_dict['diaact2id'], full_dict['user_inform_slot2id'], full_dict['user_request_slot2id']]
+        offsets = np.cumsum([0] + [len(item2id) for item2id in item2id_lst])
+        self.label_size = int(offsets[-1])
+
+        self.vocab_size = len(id2token) if id2token is not None else 0
+        # one more id than the vocabulary: the padding of ragged predictions, neither a field nor a value
+        self.token_field = np.zeros(self.vocab_size + 1, dtype=np.int64)
+        self.value_column = np.full((len(self.FIELDS) + 1, self.vocab_size + 1), -1, dtype=np.int64)
+        bad_slot = ['<PAD>', '<EOS>', '<SOS>'] + self.FIELDS
+        for token_id in range(self.vocab_size):
+            token = id2token[token_id]
+            if token in self.FIELDS:
+                self.token_field[token_id] = self.FIELDS.index(token) + 1
+            if token in bad_slot:
+                continue
+            for field_id, item2id in enumerate(item2id_lst):
+                if token in item2id:
+                    self.value_column[field_id + 1, token_id] = offsets[field_id] + item2id[token]
+
+        # label column -> (field, name), with the segment boundaries of vector2action; the name is None for a column
+        # missing from the dict, actions() raises a KeyError when it is predicted
+        id2diaact = full_dict['id2diaact']
+        id2user_inform_slot = full_dict['id2user_inform_slot']
+        id2user_request_slot = full_dict['id2user_request_slot']
+        diaact_end = len(id2diaact)
+        inform_slot_end = len(id2user_request_slot) + diaact_end
+        self.column_field = []
+        self.column_name = []
+        for column in range(self.label_size):
+            if column < diaact_end:
+                self.column_field.append('diaact')
+                self.column_name.append(id2diaact.get(str(column)))
+            elif column < inform_slot_end:
+                self.column_field.append('inform_slots')
+                self.column_name.append(id2user_inform_slot.get(str(column - diaact_end)))
+            else:
+                self.column_field.append('request_slots')
+                self.column_name.append(id2user_request_slot.get(str(column - inform_slot_end)))
+
+    def token_matrix(self, token_ids):
+        """ (B, L) token id matrix of a batch of predictions, ragged ones padded with the padding id """
+        if torch.is_tensor(token_ids):
+            return token_ids.cpu().numpy().astype(np.int64)
+        if isinstance(token_ids, np.ndarray):
+            return token_ids.astype(np.int64)
+        max_len = max([len(ids) for ids in token_ids] + [0])
+        matrix = np.full((len(token_ids), max_len), self.vocab_size, dtype=np.int64)
+        for row, ids in zip(matrix, token_ids):
+            row[:len(ids)] = [int(i) for i in ids]
+        return matrix
+
+    def label_matrix(self, token_ids):
+        """ gen2vector of every prediction of a batch: (B, label_size) multi-hot matrix """
+        tokens = self.token_matrix(token_ids)
+        labels = np.zeros((len(tokens), self.label_size + 1), dtype=np.int64)  # last column takes invalid pairs
+        if tokens.shape[1] > 1:
+            columns = self.value_column[self.token_field[tokens[:, :-1]], tokens[:, 1:]]
+            columns[columns < 0] = self.label_size
+            labels[np.arange(len(tokens))[:, None], columns] = 1
+        return labels[:, :self.label_size]
+
+    def actions(self, labels):
+        """ vector2action of every row of a multi-hot label matrix """
+        labels = labels.cpu().numpy() if torch.is_tensor(labels) else np.asarray(labels)
+        ret = [{'diaact': '', 'inform_slots': [], 'request_slots': []} for _ in range(len(labels))]
+        rows, columns = np.nonzero(labels == 1)  # row by row, in column order
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            field = self.column_field[column]
+            if field == 'diaact' and ret[row]['diaact']:
+                print('Warning: multi-action predicted')
+                continue
+            name = self.column_name[column]
+            if name is None:  # as the dict lookup of vector2action
+                raise KeyError('label column {} ({}) has no entry in the dict'.format(column, field))
+            if field != 'diaact':
+                ret[row][field].append(name)
+            else:
+                ret[row]['diaact'] = name
+        return ret
+
+    def decode(self, token_ids):
+        """ vector2action(gen2vector(...)) of every prediction of a batch """
+        return self.actions(self.label_matrix(token_ids))
+
+
+def eval_model(model, batches, full_dict, opt):
 
     if opt.output is not None:
         output_path = opt.output
@@ -303,7 +412,8 @@ def eval_model(model, valid_x, valid_y, full_dict, opt):
     model.eval()
 
     all_preds = []
-    for x, y in zip(valid_x, valid_y):
+    all_golds = []
+    for x, y in batches:
         output = model.forward(x, y)
         output_data = output
         # for s, pred_a, gold_a in zip(x, output_data, y):
@@ -315,26 +425,18 @@ def eval_model(model, valid_x, valid_y, full_dict, opt):
             # if output_file:
             #     output_file.write(json.dumps(log))
         all_preds.extend(output_data)
+        all_golds.extend(y.cpu().tolist())  # copied, the batch tensors are reused by the loader
 
     output_file.close()
-    if type(valid_y) == list:
-        tmp = []
-        for yi in valid_y:
-            tmp.extend(yi)
-        valid_y = tmp
-    else:
-        valid_y = torch.cat(valid_y)  # re-form batches into one
     if opt.select_model in USE_TEACHER_FORCING_LIST:
-        precision, recall, f1 = get_f1_from_generation(pred_tags_lst=all_preds, golden_tags_lst=valid_y, full_dict=full_dict)
+        precision, recall, f1 = get_f1_from_generation(pred_tags_lst=all_preds, golden_tags_lst=all_golds, full_dict=full_dict)
     else:
-        precision, recall, f1 = get_f1(pred_tags_lst=all_preds, golden_tags_lst=valid_y)
+        precision, recall, f1 = get_f1(pred_tags_lst=all_preds, golden_tags_lst=all_golds)
     return precision, recall, f1
 
 
 def train_model(epoch, model, optimizer,
-                train_x, train_y,
-                valid_x, valid_y,
-                test_x, test_y,
+                train_batches, valid_batches, test_batches,
                 full_dict, best_valid, test_f1_score):
     model.train()
     opt = model.opt
@@ -343,12 +445,7 @@ def train_model(epoch, model, optimizer,
     cnt = 0
     start_time = time.time()
 
-    lst = list(range(len(train_x)))
-    random.shuffle(lst)
-    train_x = [train_x[l] for l in lst]
-    train_y = [train_y[l] for l in lst]
-
-    for x, y in zip(train_x, train_y):
+    for x, y in train_batches:
         cnt += 1
         model.zero_grad()
         if opt.select_model in USE_TEACHER_FORCING_LIST:
@@ -357,7 +454,7 @@ def train_model(epoch, model, optimizer,
         else:
             _, loss = model.forward(x, y)
         total_loss += loss.data[0]
-        n_tags = len(train_y[0]) * len(x)
+        n_tags = len(y) * len(x)
         loss.backward()
         torch.nn.utils.clip_grad_norm(model.parameters(), opt.clip_grad)
         optimizer.step()
@@ -367,8 +464,12 @@ def train_model(epoch, model, optimizer,
                 1.0 * loss.data[0] / n_tags, time.time() - start_time
             ))
             start_time = time.time()
+    stats = train_batches.epoch_stats
+    logging.info("Epoch={} samples={} batches={} time={:.2f}s batch_wait={:.2f}s throughput={:.1f} samples/s".format(
+        epoch, stats['samples'], stats['batches'], stats['seconds'], stats['wait_seconds'],
+        stats['samples_per_second']))
 
-    dev_precision, dev_recall, dev_f1_score = eval_model(model, valid_x, valid_y, full_dict, opt)
+    dev_precision, dev_recall, dev_f1_score = eval_model(model, valid_batches, full_dict, opt)
     logging.info("Epoch={} iter={} lr={:.6f} train_loss={:.6f} valid_f1={:.6f} valid_p={:.6f} valid_r={:.6f}".format(
         epoch, cnt, optimizer.param_groups[0]['lr'], total_loss, dev_f1_score, dev_precision, dev_recall))
 
@@ -412,85 +513,170 @@ def train_model(epoch, model, optimizer,
             os.path.join(opt.model, opt.model_name)
         )
         best_valid = dev_f1_score
-        test_precision, test_recall, test_f1_score = eval_model(model, test_x, test_y, full_dict, opt)
+        test_precision, test_recall, test_f1_score = eval_model(model, test_batches, full_dict, opt)
         logging.info("New record achieved!")
         logging.info("Epoch={} iter={} lr={:.6f} test_precision={:.6f}, test_recall={:.6f}, test_f1={:.6f}".format(
             epoch, cnt, optimizer.param_groups[0]['lr'], test_precision, test_recall, test_f1_score))
     return best_valid, test_f1_score
 
 
-def create_one_batch(x, y, use_cuda=False, tensor=True):
-    batch_size = len(x)
-    lens = [len(xi) for xi in x]
-    max_len = max(lens)  # for variable length situation for current situation
-
-    if tensor:
-        batch_x = torch.LongTensor(x)
-        batch_y = torch.LongTensor(y)
-        if use_cuda:
-            batch_x = batch_x.cuda()
-            batch_y = batch_y.cuda()
-    else:
-        batch_x = x
-        batch_y = y
-    return batch_x, batch_y, lens
-
-
-def create_batches(x, y, batch_size, sort=True, shuffle=True, use_cuda=False, tensor=True):
-    lst = list(range(len(x)))
-    if shuffle:
-        random.shuffle(lst)
-    if sort:
-        lst = sorted(lst, key=lambda i: -len(x[i]))
-
-    x = [x[i] for i in lst]
-    y = [y[i] for i in lst]
-
-    nbatch = (len(x) - 1) // batch_size + 1  # subtract 1 fist to handle situation: len(x) // batch_size == 0
-    batches_x, batches_y = [], []
-
-    for i in range(nbatch):
-        start_id, end_id = i * batch_size, (i + 1) * batch_size
-        bx, by, _ = create_one_batch(x[start_id: end_id], y[start_id: end_id], use_cuda, tensor)
-
-        batches_x.append(bx)
-        batches_y.append(by)
-
-    if sort:
-        pos_lst = list(range(nbatch))
-        random.shuffle(pos_lst)
-
-        batches_x = [batches_x[i] for i in pos_lst]
-        batches_y = [batches_y[i] for i in pos_lst]
-
-    logging.info("{} batches, batch size: {}".format(nbatch, batch_size))
-    return batches_x, batches_y
+class BatchLoader(object):
+    """
+    Iterate over the (batch_x, batch_y) LongTensor batches of a dataset, the next batches being assembled by a
+    background thread while the model trains on the current one.
+    Samples are bucketed by length (a batch only holds samples of one length) and the batches are re-drawn at each
+    epoch from a shuffled index list; the dataset itself (lists, or the npy arrays of load_cooked_data) is never
+    copied, only gathered batch by batch into a ring of pre-allocated tensors (pinned when use_cuda).
+    A yielded batch is overwritten once prefetch + 1 more batches were drawn: copy what has to outlive the step.
+    """
+    def __init__(self, x, y, batch_size, sort=True, shuffle=True, use_cuda=False, prefetch=2):
+        """
+        :param x: samples, indexable by position (list or numpy array)
+        :param y: labels, aligned with x
+        :param batch_size: samples per batch
+        :param sort: bucket the samples by length
+        :param shuffle: draw new batches and a new batch order at each epoch; dev/test sets keep the data order
+        :param use_cuda: move the batches to the gpu
+        :param prefetch: the number of batches assembled ahead, 0 to assemble them in the training thread
+        """
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.sort = sort
+        self.shuffle = shuffle
+        self.use_cuda = use_cuda
+        self.prefetch = prefetch
+        if isinstance(x, np.ndarray):
+            self.lengths = None  # every sample has x.shape[1] columns
+            bucket_sizes = [len(x)]
+        else:
+            self.lengths = [len(xi) for xi in x]
+            bucket_sizes = np.unique(self.lengths, return_counts=True)[1] if sort else [len(x)]
+        self.nbatch = sum((size - 1) // batch_size + 1 for size in bucket_sizes)
+        self.ring_size = prefetch + 2  # the batch in use, the ones queued and the one being assembled
+        self.buffers = {}
+        self.epoch_stats = {}
+        logging.info("{} batches, batch size: {}".format(len(self), batch_size))
+
+    def __len__(self):
+        return self.nbatch
+
+    def batch_indices(self):
+        """ The sample ids of every batch of one epoch, in the order they are served """
+        lst = list(range(len(self.x)))
+        if self.shuffle:
+            random.shuffle(lst)
+        if self.sort and self.lengths is not None:
+            buckets = {}
+            for i in lst:
+                buckets.setdefault(self.lengths[i], []).append(i)
+            bucket_lst = [buckets[length] for length in sorted(buckets, reverse=True)]
+        else:
+            bucket_lst = [lst]
+
+        batches = []
+        for bucket in bucket_lst:
+            batches.extend(bucket[start: start + self.batch_size] for start in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def gather(self, data, ids, name, slot):
+        """ Copy the samples ids of data into the slot-th buffer of name, return the filled part """
+        if isinstance(data, np.ndarray):
+            rows = data[np.asarray(ids)]
+        else:
+            rows = [data[i] for i in ids]
+        shape = (self.batch_size,) + np.shape(rows[0])
+        key = (name, slot, shape)
+        if key not in self.buffers:
+            buf = torch.LongTensor(*shape).zero_()
+            self.buffers[key] = buf.pin_memory() if self.use_cuda else buf
+        batch = self.buffers[key][:len(ids)]
+        batch.numpy()[...] = rows
+        return batch.cuda() if self.use_cuda else batch
+
+    def make_batch(self, ids, slot):
+        return self.gather(self.x, ids, 'x', slot), self.gather(self.y, ids, 'y', slot)
+
+    def produce(self, batches, queue, stop):
+        """ Worker thread: queue ('batch', batch) for every batch in order, then ('end', None) or ('error', exc_info) """
+        def offer(message):
+            while not stop.is_set():
+                try:
+                    queue.put(message, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        try:
+            for k, ids in enumerate(batches):
+                if not offer(('batch', self.make_batch(ids, k % self.ring_size))):
+                    return
+            offer(('end', None))
+        except Exception:
+            offer(('error', sys.exc_info()))
+
+    def __iter__(self):
+        batches = self.batch_indices()  # drawn here so that the random state does not depend on the worker
+        start_time = time.time()
+        wait_time = 0.0
+        samples = 0
+        if self.prefetch <= 0:
+            for ids in batches:
+                wait_start = time.time()
+                item = self.make_batch(ids, 0)
+                wait_time += time.time() - wait_start
+                samples += len(ids)
+                yield item
+        else:
+            queue = Queue.Queue(maxsize=self.prefetch)
+            stop = threading.Event()
+            worker = threading.Thread(target=self.produce, args=(batches, queue, stop))
+            worker.daemon = True
+            worker.start()
+            try:
+                while True:
+                    wait_start = time.time()
+                    kind, item = queue.get()
+                    wait_time += time.time() - wait_start
+                    if kind == 'end':
+                        break
+                    if kind == 'error':
+                        raise item[0], item[1], item[2]
+                    samples += len(item[0])
+                    yield item
+            finally:
+                stop.set()
+                worker.join()
+        seconds = time.time() - start_time
+        self.epoch_stats = {
+            'batches': len(batches),
+            'samples': samples,
+            'seconds': seconds,
+            'wait_seconds': wait_time,  # time the training loop spent waiting for a batch
+            'samples_per_second': samples / seconds if seconds > 0 else 0.0,
+        }
 
 
 def one_turn_classification(opt):
     use_cuda = opt.gpu >= 0 and torch.cuda.is_available()
-    with open(opt.train_path, 'r') as train_file, \
-            open(opt.dev_path, 'r') as dev_file, \
-            open(opt.test_path, 'r') as test_file, \
-            open(opt.dict_path, 'r') as dict_file:
+    with open(opt.dict_path, 'r') as dict_file:
         logging.info('Start loading data from:\ntrain:{}\ndev:{}\ntest:{}\ndict:{}\n'.format(
             opt.train_path, opt.dev_path, opt.test_path, opt.dict_path
         ))
-        train_data = json.load(train_file)
-        dev_data = json.load(dev_file)
-        test_data = json.load(test_file)
+        train_input, train_label, train_turn_id = load_cooked_data(opt.train_path)
+        dev_input, dev_label, dev_turn_id = load_cooked_data(opt.dev_path)
+        test_input, test_label, test_turn_id = load_cooked_data(opt.test_path)
         full_dict = json.load(dict_file)
 
         # TODO: change full dict to a whole dict
         logging.info('Finish data loading.')
         print('Finish  data loading!!!!!!!!!!')
-        # unpack data
-        train_input, train_label, train_turn_id = zip(* train_data)
-        dev_input, dev_label, dev_turn_id = zip(* dev_data)
-        test_input, test_label, test_turn_id = zip(* test_data)
-        train_x, train_y = create_batches(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
-        dev_x, dev_y = create_batches(dev_input, dev_label, opt.batch_size, use_cuda=use_cuda)
-        test_x, test_y = create_batches(test_input, test_label, opt.batch_size, use_cuda=use_cuda)
+        train_batches = BatchLoader(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
+        dev_batches = BatchLoader(dev_input, dev_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
+        test_batches = BatchLoader(test_input, test_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
 
         input_size = len(train_input[0])
         num_tags = len(train_label[0])
@@ -505,9 +691,7 @@ def one_turn_classification(opt):
                 epoch=epoch,
                 model=classifier,
                 optimizer=optimizer,
-                train_x=train_x, train_y=train_y,
-                valid_x=dev_x, valid_y=dev_y,
-                test_x=test_x, test_y=test_y,
+                train_batches=train_batches, valid_batches=dev_batches, test_batches=test_batches,
                 full_dict=full_dict, best_valid=best_valid, test_f1_score=test_result
             )
             if opt.lr_decay > 0:
@@ -535,34 +719,27 @@ def transform_data_into_history_style(data, turn_ids, history_turns=5):
 
 def history_based_classification(opt):
     use_cuda = opt.gpu >= 0 and torch.cuda.is_available()
-    with open(opt.train_path, 'r') as train_file, \
-            open(opt.dev_path, 'r') as dev_file, \
-            open(opt.test_path, 'r') as test_file, \
-            open(opt.dict_path, 'r') as dict_file:
+    with open(opt.dict_path, 'r') as dict_file:
         logging.info('Start loading data from:\ntrain:{}\ndev:{}\ntest:{}\ndict:{}\n'.format(
             opt.train_path, opt.dev_path, opt.test_path, opt.dict_path
         ))
-        train_data = json.load(train_file)
-        dev_data = json.load(dev_file)
-        test_data = json.load(test_file)
+        train_input, train_label, train_turn_id = load_cooked_data(opt.train_path)
+        dev_input, dev_label, dev_turn_id = load_cooked_data(opt.dev_path)
+        test_input, test_label, test_turn_id = load_cooked_data(opt.test_path)
         full_dict = json.load(dict_file)
 
         # TODO: change full dict to a whole dict
         logging.info('Finish data loading.')
         print('Finish  data loading!!!!!!!!!!')
-        # unpack data
-        train_input, train_label, train_turn_id = zip(*train_data)
-        dev_input, dev_label, dev_turn_id = zip(*dev_data)
-        test_input, test_label, test_turn_id = zip(*test_data)
 
         # stack history
         train_input = transform_data_into_history_style(train_input, train_turn_id)
         dev_input = transform_data_into_history_style(dev_input, dev_turn_id)
         test_input = transform_data_into_history_style(test_input, test_turn_id)
 
-        train_x, train_y = create_batches(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
-        dev_x, dev_y = create_batches(dev_input, dev_label, opt.batch_size, use_cuda=use_cuda)
-        test_x, test_y = create_batches(test_input, test_label, opt.batch_size, use_cuda=use_cuda)
+        train_batches = BatchLoader(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
+        dev_batches = BatchLoader(dev_input, dev_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
+        test_batches = BatchLoader(test_input, test_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
 
         input_size = len(train_input[0][0])
         num_tags = len(train_label[0])
@@ -579,9 +756,7 @@ def history_based_classification(opt):
                 epoch=epoch,
                 model=classifier,
                 optimizer=optimizer,
-                train_x=train_x, train_y=train_y,
-                valid_x=dev_x, valid_y=dev_y,
-                test_x=test_x, test_y=test_y,
+                train_batches=train_batches, valid_batches=dev_batches, test_batches=test_batches,
                 full_dict=full_dict, best_valid=best_valid, test_f1_score=test_result
             )
             if opt.lr_decay > 0:
@@ -651,25 +826,18 @@ def transform_label_into_sequence_style(labels, full_dict, sos_token, eos_token,
 
 def seq2seq_action_generation(opt, single_turn_history=False):
     use_cuda = opt.gpu >= 0 and torch.cuda.is_available()
-    with open(opt.train_path, 'r') as train_file, \
-            open(opt.dev_path, 'r') as dev_file, \
-            open(opt.test_path, 'r') as test_file, \
-            open(opt.dict_path, 'r') as dict_file:
+    with open(opt.dict_path, 'r') as dict_file:
         logging.info('Start loading data from:\ntrain:{}\ndev:{}\ntest:{}\ndict:{}\n'.format(
             opt.train_path, opt.dev_path, opt.test_path, opt.dict_path
         ))
-        train_data = json.load(train_file)
-        dev_data = json.load(dev_file)
-        test_data = json.load(test_file)
+        train_input, train_label, train_turn_id = load_cooked_data(opt.train_path)
+        dev_input, dev_label, dev_turn_id = load_cooked_data(opt.dev_path)
+        test_input, test_label, test_turn_id = load_cooked_data(opt.test_path)
         full_dict = json.load(dict_file)
 
         logging.info('Finish data loading.')
         print('Finish  data loading!!!!!!!!!!')
 
-        # unpack data
-        train_input, train_label, train_turn_id = zip(*train_data)
-        dev_input, dev_label, dev_turn_id = zip(*dev_data)
-        test_input, test_label, test_turn_id = zip(*test_data)
 
         # stack history
         if not single_turn_history:
@@ -702,9 +870,9 @@ def seq2seq_action_generation(opt, single_turn_history=False):
         test_label = transform_label_into_sequence_style(test_label, full_dict, sos_token, eos_token, pad_token)
 
         # create batches
-        train_x, train_y = create_batches(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
-        dev_x, dev_y = create_batches(dev_input, dev_label, opt.batch_size, use_cuda=use_cuda)
-        test_x, test_y = create_batches(test_input, test_label, opt.batch_size, use_cuda=use_cuda)
+        train_batches = BatchLoader(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
+        dev_batches = BatchLoader(dev_input, dev_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
+        test_batches = BatchLoader(test_input, test_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
         #
         # for i in range(3):
         #     print('========= DEBUG =========', train_x[0][i])
@@ -728,9 +896,7 @@ def seq2seq_action_generation(opt, single_turn_history=False):
                 epoch=epoch,
                 model=classifier,
                 optimizer=optimizer,
-                train_x=train_x, train_y=train_y,
-                valid_x=dev_x, valid_y=dev_y,
-                test_x=test_x, test_y=test_y,
+                train_batches=train_batches, valid_batches=dev_batches, test_batches=test_batches,
                 full_dict=full_dict, best_valid=best_valid, test_f1_score=test_result
             )
             if opt.lr_decay > 0:
@@ -744,25 +910,18 @@ def seq2seq_action_generation(opt, single_turn_history=False):
 
 def seq2seq_att_action_generation(opt, single_turn_history=False):
     use_cuda = opt.gpu >= 0 and torch.cuda.is_available()
-    with open(opt.train_path, 'r') as train_file, \
-            open(opt.dev_path, 'r') as dev_file, \
-            open(opt.test_path, 'r') as test_file, \
-            open(opt.dict_path, 'r') as dict_file:
+    with open(opt.dict_path, 'r') as dict_file:
         logging.info('Start loading data from:\ntrain:{}\ndev:{}\ntest:{}\ndict:{}\n'.format(
             opt.train_path, opt.dev_path, opt.test_path, opt.dict_path
         ))
-        train_data = json.load(train_file)
-        dev_data = json.load(dev_file)
-        test_data = json.load(test_file)
+        train_input, train_label, train_turn_id = load_cooked_data(opt.train_path)
+        dev_input, dev_label, dev_turn_id = load_cooked_data(opt.dev_path)
+        test_input, test_label, test_turn_id = load_cooked_data(opt.test_path)
         full_dict = json.load(dict_file)
 
         logging.info('Finish data loading.')
         print('Finish  data loading!!!!!!!!!!')
 
-        # unpack data
-        train_input, train_label, train_turn_id = zip(*train_data)
-        dev_input, dev_label, dev_turn_id = zip(*dev_data)
-        test_input, test_label, test_turn_id = zip(*test_data)
 
         # stack history
         if not single_turn_history:
@@ -795,9 +954,9 @@ def seq2seq_att_action_generation(opt, single_turn_history=False):
         test_label = transform_label_into_sequence_style(test_label, full_dict, sos_token, eos_token, pad_token)
 
         # create batches
-        train_x, train_y = create_batches(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
-        dev_x, dev_y = create_batches(dev_input, dev_label, opt.batch_size, use_cuda=use_cuda)
-        test_x, test_y = create_batches(test_input, test_label, opt.batch_size, use_cuda=use_cuda)
+        train_batches = BatchLoader(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
+        dev_batches = BatchLoader(dev_input, dev_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
+        test_batches = BatchLoader(test_input, test_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
         #
         # for i in range(3):
         #     print('========= DEBUG =========', train_x[0][i])
@@ -821,9 +980,7 @@ def seq2seq_att_action_generation(opt, single_turn_history=False):
                 epoch=epoch,
                 model=classifier,
                 optimizer=optimizer,
-                train_x=train_x, train_y=train_y,
-                valid_x=dev_x, valid_y=dev_y,
-                test_x=test_x, test_y=test_y,
+                train_batches=train_batches, valid_batches=dev_batches, test_batches=test_batches,
                 full_dict=full_dict, best_valid=best_valid, test_f1_score=test_result
             )
             if opt.lr_decay > 0:
@@ -835,61 +992,20 @@ def seq2seq_att_action_generation(opt, single_turn_history=False):
         logging.info("test_f1: {:.6f}".format(test_result))
 
 
-def convert_data_into_state_style(datas, full_dict, sample_style='multi-hot', history_turns=1):
-    ret = []
-    for item in datas:
-        dialog_state_dict = vector2state(item, full_dict)
-        # Content:
-        # {
-        #         'state_vectors': state_vector_components,
-        #         'user_goal': user_goal,
-        #         'sys_action': sys_action,  # request slots, inform slots, diaact, speaker
-        #         'history_slots': history_slots,  # pos: informed, neg: not_informed, irr: irrelevant
-        #         'rest_slots': rest_slots,  # pos: remained, neg: already_got, irrelevant
-        #         'consistent_slots': consistent_slots,  # pos: consistent, neg: inconsistent, irrelevant
-        #         'dialog_status': dialog_status,
-        # }
-        if sample_style == 'multi-hot':
-            sample = dialog_state_dict['state_vector_list']
-        else:
-            raise NotImplementedError
-
-        if history_turns == 1:
-            ret.append(sample)
-        elif history_turns == -1:
-            ''' no history length limit, do padding here '''
-            raise NotImplementedError
-        else:
-            raise NotImplementedError
-    return ret
-
-
 def state2seq_action_generation(opt):
     use_cuda = opt.gpu >= 0 and torch.cuda.is_available()
-    with open(opt.train_path, 'r') as train_file, \
-            open(opt.dev_path, 'r') as dev_file, \
-            open(opt.test_path, 'r') as test_file, \
-            open(opt.dict_path, 'r') as dict_file:
+    with open(opt.dict_path, 'r') as dict_file:
         logging.info('Start loading data from:\ntrain:{}\ndev:{}\ntest:{}\ndict:{}\n'.format(
             opt.train_path, opt.dev_path, opt.test_path, opt.dict_path
         ))
-        train_data = json.load(train_file)
-        dev_data = json.load(dev_file)
-        test_data = json.load(test_file)
+        train_input, train_label, train_turn_id = load_cooked_data(opt.train_path)
+        dev_input, dev_label, dev_turn_id = load_cooked_data(opt.dev_path)
+        test_input, test_label, test_turn_id = load_cooked_data(opt.test_path)
         full_dict = json.load(dict_file)
 
         logging.info('Finish data loading.')
         print('Finish  data loading!!!!!!!!!!')
 
-        ''' unpack data '''
-        train_input, train_label, train_turn_id = zip(*train_data)
-        dev_input, dev_label, dev_turn_id = zip(*dev_data)
-        test_input, test_label, test_turn_id = zip(*test_data)
-
-        ''' change input to a state format of multi-vector'''
-        train_input = convert_data_into_state_style(train_input, full_dict)
-        dev_input = convert_data_into_state_style(dev_input, full_dict)
-        test_input = convert_data_into_state_style(test_input, full_dict)
 
         ''' gen tgt dict '''
         sos_token = '<SOS>'
@@ -916,12 +1032,12 @@ def state2seq_action_generation(opt):
         test_label = transform_label_into_sequence_style(test_label, full_dict, sos_token, eos_token, pad_token)
 
         ''' create batches '''
-        # input for each sample is a list, so don't change to tensor here
-        train_x, train_y = create_batches(train_input, train_label, opt.batch_size, use_cuda=use_cuda, tensor=False)
-        dev_x, dev_y = create_batches(dev_input, dev_label, opt.batch_size, use_cuda=use_cuda, tensor=False)
-        test_x, test_y = create_batches(test_input, test_label, opt.batch_size, use_cuda=use_cuda, tensor=False)
+        # input for each sample is the flat state vector, sliced into components by the StateEncoder
+        train_batches = BatchLoader(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
+        dev_batches = BatchLoader(dev_input, dev_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
+        test_batches = BatchLoader(test_input, test_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
 
-        input_size = len(train_input[0][0])
+        input_size = len(train_input[0])
 
         classifier = State2Seq(
             slot_num=len(full_dict['user_inform_slot2id']), diaact_num=len(full_dict['diaact2id']),
@@ -942,9 +1058,7 @@ def state2seq_action_generation(opt):
                 epoch=epoch,
                 model=classifier,
                 optimizer=optimizer,
-                train_x=train_x, train_y=train_y,
-                valid_x=dev_x, valid_y=dev_y,
-                test_x=test_x, test_y=test_y,
+                train_batches=train_batches, valid_batches=dev_batches, test_batches=test_batches,
                 full_dict=full_dict, best_valid=best_valid, test_f1_score=test_result
             )
             if opt.lr_decay > 0:
@@ -958,30 +1072,18 @@ def state2seq_action_generation(opt):
 
 def state2seq_no_att_action_generation(opt):
     use_cuda = opt.gpu >= 0 and torch.cuda.is_available()
-    with open(opt.train_path, 'r') as train_file, \
-            open(opt.dev_path, 'r') as dev_file, \
-            open(opt.test_path, 'r') as test_file, \
-            open(opt.dict_path, 'r') as dict_file:
+    with open(opt.dict_path, 'r') as dict_file:
         logging.info('Start loading data from:\ntrain:{}\ndev:{}\ntest:{}\ndict:{}\n'.format(
             opt.train_path, opt.dev_path, opt.test_path, opt.dict_path
         ))
-        train_data = json.load(train_file)
-        dev_data = json.load(dev_file)
-        test_data = json.load(test_file)
+        train_input, train_label, train_turn_id = load_cooked_data(opt.train_path)
+        dev_input, dev_label, dev_turn_id = load_cooked_data(opt.dev_path)
+        test_input, test_label, test_turn_id = load_cooked_data(opt.test_path)
         full_dict = json.load(dict_file)
 
         logging.info('Finish data loading.')
         print('Finish  data loading!!!!!!!!!!')
 
-        ''' unpack data '''
-        train_input, train_label, train_turn_id = zip(*train_data)
-        dev_input, dev_label, dev_turn_id = zip(*dev_data)
-        test_input, test_label, test_turn_id = zip(*test_data)
-
-        ''' change input to a state format of multi-vector'''
-        train_input = convert_data_into_state_style(train_input, full_dict)
-        dev_input = convert_data_into_state_style(dev_input, full_dict)
-        test_input = convert_data_into_state_style(test_input, full_dict)
 
         ''' gen tgt dict '''
         sos_token = '<SOS>'
@@ -1008,12 +1110,12 @@ def state2seq_no_att_action_generation(opt):
         test_label = transform_label_into_sequence_style(test_label, full_dict, sos_token, eos_token, pad_token)
 
         ''' create batches '''
-        # input for each sample is a list, so don't change to tensor here
-        train_x, train_y = create_batches(train_input, train_label, opt.batch_size, use_cuda=use_cuda, tensor=False)
-        dev_x, dev_y = create_batches(dev_input, dev_label, opt.batch_size, use_cuda=use_cuda, tensor=False)
-        test_x, test_y = create_batches(test_input, test_label, opt.batch_size, use_cuda=use_cuda, tensor=False)
+        # input for each sample is the flat state vector, sliced into components by the StateEncoder
+        train_batches = BatchLoader(train_input, train_label, opt.batch_size, use_cuda=use_cuda)
+        dev_batches = BatchLoader(dev_input, dev_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
+        test_batches = BatchLoader(test_input, test_label, opt.batch_size, shuffle=False, use_cuda=use_cuda)
 
-        input_size = len(train_input[0][0])
+        input_size = len(train_input[0])
 
         classifier = State2Seq(
             slot_num=len(full_dict['user_inform_slot2id']), diaact_num=len(full_dict['diaact2id']),
@@ -1034,9 +1136,7 @@ def state2seq_no_att_action_generation(opt):
                 epoch=epoch,
                 model=classifier,
                 optimizer=optimizer,
-                train_x=train_x, train_y=train_y,
-                valid_x=dev_x, valid_y=dev_y,
-                test_x=test_x, test_y=test_y,
+                train_batches=train_batches, valid_batches=dev_batches, test_batches=test_batches,
                 full_dict=full_dict, best_valid=best_valid, test_f1_score=test_result
             )
             if opt.lr_decay > 0:
@@ -0,0 +1,70 @@
+# coding: utf-8
+"""
+Batched action prediction for the neural user simulators
+
+The user simulators of concurrent dialogs submit their state representations (observe()), the server answers all
+the pending requests of one tick with a single model forward pass per model (predict_action_batch()), and the
+predictions are scattered back to the simulators (respond()).
+"""
+from __future__ import print_function
+
+
+class UserSimulatorInferenceServer(object):
+    def __init__(self, max_batch_size=64):
+        """
+        :param max_batch_size: the largest number of requests sent to a model in one forward pass
+        """
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.results = {}
+        self.next_ticket = 0
+
+        self.requests = 0
+        self.batches = 0
+
+    @staticmethod
+    def supports(user_sim):
+        """ whether the predictions of user_sim can be batched by the server """
+        return hasattr(user_sim, 'predict_action_batch') and hasattr(user_sim, 'observe') and hasattr(user_sim, 'respond')
+
+    def submit(self, user_sim, state_representation):
+        """ queue a prediction request, return the ticket its result is stored under """
+        ticket = self.next_ticket
+        self.next_ticket += 1
+        self.pending.append((ticket, user_sim, state_representation))
+        return ticket
+
+    def tick(self):
+        """ answer every pending request, one forward pass per model (and per max_batch_size requests) """
+        groups = {}
+        order = []
+        for request in self.pending:
+            key = id(request[1].classifier)  # simulators sharing a model share its batches
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(request)
+        self.pending = []
+
+        for key in order:
+            requests = groups[key]
+            for start in range(0, len(requests), self.max_batch_size):
+                chunk = requests[start:start + self.max_batch_size]
+                pred_actions = chunk[0][1].predict_action_batch([request[2] for request in chunk])
+                for request, pred_action in zip(chunk, pred_actions):
+                    self.results[request[0]] = pred_action
+                self.requests += len(chunk)
+                self.batches += 1
+
+    def result(self, ticket):
+        """ pop the predicted action of a ticket answered by tick() """
+        return self.results.pop(ticket)
+
+    def predict(self, requests):
+        """ predict the actions of a list of (user_sim, state_representation) requests in as few batches as possible """
+        tickets = [self.submit(user_sim, state_representation) for user_sim, state_representation in requests]
+        self.tick()
+        return [self.result(ticket) for ticket in tickets]
+
+    def stats(self):
+        return {'requests': self.requests, 'batches': self.batches}
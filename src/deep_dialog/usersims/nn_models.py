@@ -585,62 +585,59 @@ class StateEncoder(nn.Module):
         self.h_relu = nn.ReLU()
         self.c_relu = nn.ReLU()
 
+        ''' Column layout of the flat state vector: the components follow state_v_component '''
+        embedding_sizes = [
+            ('slot_embedding', slot_num), ('diaact_embedding', diaact_num), ('dialog_status_embedding', 1)
+        ]
+        component_embeddings = [
+            'diaact_embedding' if name == 'system_diaact_v' else
+            'dialog_status_embedding' if name == 'dialog_status_v' else 'slot_embedding'
+            for name in self.state_v_component
+        ]
+        component_offsets = []
+        offset = 0
+        for embedding_name in component_embeddings:
+            component_offsets.append(offset)
+            offset += dict(embedding_sizes)[embedding_name]
+        self.state_size = offset
+
+        self.embedding_groups = []  # (embedding name, columns of its components, component size)
+        group_components = []
+        for embedding_name, component_size in embedding_sizes:
+            components = [i for i, name in enumerate(component_embeddings) if name == embedding_name]
+            columns = [component_offsets[i] + j for i in components for j in range(component_size)]
+            columns = torch.LongTensor(columns).cuda() if use_cuda else torch.LongTensor(columns)
+            self.embedding_groups.append((embedding_name, columns, component_size))
+            group_components.extend(components)
+        component_order = [group_components.index(i) for i in range(len(component_embeddings))]
+        self.component_order = torch.LongTensor(component_order).cuda() if use_cuda else torch.LongTensor(component_order)
+
     def forward(self, batch_x, input_lengths=None):
-        batch_size = len(batch_x)
-
-        def get_batch_component(batch, component_idx):
-            '''
-            list could not proceed multi-dim slice, so write this
-            :param batch: iterable batch
-            :param component_idx:
-            :return: torch variable
-            '''
-            tmp = []
-            for sample in batch:
-                tmp.append(sample[component_idx])
-            tmp = torch.LongTensor(tmp).cuda() if self.use_cuda else torch.LongTensor(tmp)
-            return Variable(tmp).float()
-
-        ''' Extract State Representation '''
-        if len(self.state_v_component) != 9:
-            raise RuntimeError('Wrong Component! The state v component is hard coded as here and vector2state()')
-        goal_inform_slots_v = get_batch_component(batch_x, 0)
-        goal_request_slots_v = get_batch_component(batch_x, 1)
-        history_slots_v = get_batch_component(batch_x, 2)  # informed slots, 1 informed, 0 irrelevant, -1 not informed,
-        rest_slots_v = get_batch_component(batch_x, 3)  # remained request slots, 1 for remained, 0 irrelevant, -1 for already got,
-        system_diaact_v = get_batch_component(batch_x, 4)  # system diaact,
-        system_inform_slots_v = get_batch_component(batch_x, 5)  # inform slots of sys response,
-        system_request_slots_v = get_batch_component(batch_x, 6)  # request slots of sys response,
-        consistency_v = get_batch_component(batch_x, 7)  # for each pos, -1 inconsistent, 0 irrelevent or not requested, 1 consistent,
-        dialog_status_v = get_batch_component(batch_x, 8)  # -1, 0, 1 for failed, no outcome, success,
-
-        ''' Get embeddings of state component '''
-        goal_inform_slots_embedding = self.slot_embedding(goal_inform_slots_v)
-        goal_request_slots_embedding = self.slot_embedding(goal_request_slots_v)
-        history_slots_embedding = self.slot_embedding(history_slots_v)
-        rest_slots_embedding = self.slot_embedding(rest_slots_v)
-        system_diaact_embedding = self.diaact_embedding(system_diaact_v)
-        system_inform_slots_embedding = self.slot_embedding(system_inform_slots_v)
-        system_request_slots_embedding = self.slot_embedding(system_request_slots_v)
-        consistency_embedding = self.slot_embedding(consistency_v)
-        dialog_status_embedding = self.dialog_status_embedding(dialog_status_v)
+        """
+        :param batch_x: (batch, state size) tensor of flat state vectors (components in state_v_component order)
+        """
+        batch_x = batch_x if type(batch_x) == Variable else Variable(batch_x)
+        batch_x = batch_x.float()
+        if self.use_cuda:
+            batch_x = batch_x.cuda()
+        batch_size = batch_x.size(0)
+        if batch_x.dim() != 2 or batch_x.size(1) != self.state_size:
+            raise RuntimeError('Wrong state size {}! The state v component {} gives flat states of size {}'.format(
+                tuple(batch_x.size()), self.state_v_component, self.state_size))
+
+        ''' Get embeddings of state component: one projection per embedding, over all its components '''
+        group_embeddings = []
+        for embedding_name, columns, component_size in self.embedding_groups:
+            group_v = batch_x.index_select(1, columns).view(batch_size, -1, component_size)
+            embedding = getattr(self, embedding_name)
+            group_embeddings.append(F.linear(group_v, embedding.weight, embedding.bias))
+
+        ''' Build output to imitate rnn'''
+        # outputs: (batch, seq_len, hidden_size * num_directions), one step per state component
+        output = torch.cat(group_embeddings, 1).index_select(1, self.component_order)
 
         ''' Send embeddings to encoder '''
-        all_embeddings = [
-            goal_inform_slots_embedding,
-            goal_request_slots_embedding,
-            history_slots_embedding,
-            rest_slots_embedding,
-            system_diaact_embedding,
-            system_inform_slots_embedding,
-            system_request_slots_embedding,
-            consistency_embedding,
-            dialog_status_embedding
-        ]
-        concated_state = torch.cat(
-            all_embeddings,
-            1
-        )
+        concated_state = output.view(batch_size, -1)
         h_n = self.h_relu(self.h_encoder(concated_state))
         c_n = self.c_relu(self.c_encoder(concated_state))
 
@@ -654,15 +651,7 @@ class StateEncoder(nn.Module):
         c_n = torch.transpose(c_n, 0, 1)
 
         hidden = (h_n.contiguous(), c_n.contiguous())
-
-        ''' Build output to imitate rnn'''
-        # outputs: (batch, seq_len, hidden_size * num_directions)
-        for ei in all_embeddings:
-            ei.unsqueeze_(0)  # add one extra dimension
-        output = torch.cat(all_embeddings, 0)
-        output = torch.transpose(output, 0, 1).contiguous()  # convert to batch first to fit decoder's need
-        # print(output.size(), h_n.size(), c_n.size())
-        return output, hidden
+        return output.contiguous(), hidden
 
 
 class State2Seq(nn.Module):
@@ -1,16 +1,24 @@
 # coding: utf-8
 from __future__ import print_function, division
+import argparse
+import ast
 import json
 import re
 import sys
 import os
 try:
     from deep_dialog import dialog_config
+    from deep_dialog.dialog_system.trace_writer import is_trace_file, iter_trace_records
 except:
     sys.path.append("..")
     import dialog_config
+    sys.path.append("../dialog_system")
+    from trace_writer import is_trace_file, iter_trace_records
 import logging
-import copy
+import numpy as np
+import itertools
+import multiprocessing
+import time
 
 LOG_PATH = dialog_config.TRAIN_LOG_PATH
 EXTRACTED_LOG_DATA_PATH = dialog_config.EXTRACTED_LOG_DATA_PATH
@@ -71,8 +79,8 @@ def process_one_dialogue(raw_data_str):
             # print(inform_slots_str)
             # inform_slots = json.loads(inform_slots_str.replace("'", "\""))
             # request_slots = json.loads(request_slots_str.replace("'", "\""))
-            inform_slots = eval(inform_slots_str)
-            request_slots = eval(request_slots_str)
+            inform_slots = ast.literal_eval(inform_slots_str)
+            request_slots = ast.literal_eval(request_slots_str)
             turn_id = ind // 2
             # acts always be the first to appear
             item = {
@@ -112,6 +120,125 @@ def process_one_dialogue(raw_data_str):
 
 
 
+TURN_ACTION_PATTERN = re.compile(r'^Turn \d+ (usr|sys): (.*?), inform_slots: (.*), request[_ ]slots: (.*)$')
+TURN_UTTERANCE_PATTERN = re.compile(r'^Turn \d+ (usr|sys): ?(.*)$')
+
+
+def dialogue_success(outcome_line):
+    """
+    :param outcome_line: the line printed when a dialogue is over
+    :return: True / False for a success / failure line, None for any other line
+    """
+    if 'Success' in outcome_line or 'Successful Dialog' in outcome_line:
+        return True
+    elif 'Fail' in outcome_line or 'Failed Dialog' in outcome_line:
+        return False
+    return None
+
+
+def add_turn_line(turns, turn_line):
+    """
+    Parse one 'Turn N ...' line into turns: an action line opens a new turn, an utterance line completes the last one
+    :param turns: the turns of the current dialogue, in the format of process_one_dialogue
+    :param turn_line: the line, without line break
+    """
+    match = TURN_ACTION_PATTERN.match(turn_line)
+    if match:
+        speaker, diaact, inform_slots_str, request_slots_str = match.groups()
+        turns.append({
+            'turn_id': len(turns),
+            'speaker': speaker,
+            'diaact': diaact,
+            'inform_slots': ast.literal_eval(inform_slots_str),
+            'request_slots': ast.literal_eval(request_slots_str)
+        })
+        return
+    match = TURN_UTTERANCE_PATTERN.match(turn_line)
+    if not match or not turns:
+        print('Error: Wrong line for turn info', turn_line)
+        raise RuntimeError
+    turns[-1]['utterance'] = match.group(2)
+
+
+def iter_log_records(reader, section='train_data'):
+    """
+    Stream a training log line by line, yielding each record as soon as its last line is read.
+    Memory use is bounded by the size of one dialogue, whatever the size of the log.
+    :param reader: file opened in binary mode, positioned at the start of the log or at an offset yielded before
+    :param section: the section the reader is positioned in, 'warm_start_data' or 'train_data'
+    :return: generator of (section, record, offset), where section is 'expr_param', 'warm_start_data' or 'train_data',
+        record is the expr params or a dialogue in the format of process_one_dialogue,
+        and offset is the byte offset right after the record, to resume from.
+        A dialogue cut off by the end of the log is not yielded.
+    """
+    state = 'idle'  # idle -> expr_param / goal (json block) ; goal -> turns ; turns -> idle
+    block_lines = []
+    user_goal, turns = None, []
+    for line in iter(reader.readline, ''):
+        if not line.endswith('\n'):  # last line of a log still being written
+            break
+        offset = reader.tell()
+        line = line.rstrip('\r\n')
+
+        if state in ('expr_param', 'goal'):
+            block_lines.append(line)
+            if line in ('}', '{}'):  # end of a json.dumps(..., indent=2) block
+                data = json.loads('\n'.join(block_lines))
+                block_lines = []
+                if state == 'expr_param':
+                    state = 'idle'
+                    yield 'expr_param', data, offset
+                else:
+                    state = 'turns'
+                    user_goal, turns = data, []
+            continue
+
+        if state == 'turns':
+            if line.startswith('Turn '):
+                add_turn_line(turns, line)
+                continue
+            state = 'idle'
+            success = dialogue_success(line)
+            if success is not None:
+                yield section, {'user_goal': user_goal, 'turns': turns, 'success': success}, offset
+                continue
+            logging.warning('Skip dialogue without outcome, interrupted by line: {0}'.format(line))
+
+        if line.startswith('Dialog Parameters: '):
+            state = 'expr_param'
+        elif line == 'New episode, user goal:':
+            state = 'goal'
+        elif line.startswith('warm_start starting ...'):
+            section = 'warm_start_data'
+        elif line.startswith('warm_start finished, start RL training ...'):
+            section = 'train_data'
+
+
+def read_last_record(jsonl_path, block_size=65536):
+    """
+    Read the last complete line of a JSON-lines file backward, dropping a partially written line after it
+    :param jsonl_path:
+    :param block_size: bytes read per step
+    :return: the last record, None for a file without any complete line
+    """
+    with open(jsonl_path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = ''
+        while pos > 0 and tail.count('\n') < 2:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+        last_line_end = tail.rfind('\n')
+        if last_line_end < 0:
+            f.truncate(0)
+            return None
+        last_line_start = tail.rfind('\n', 0, last_line_end) + 1
+        f.truncate(pos + last_line_end + 1)
+        return json.loads(tail[last_line_start:last_line_end])
+
+
 def split_raw_data(raw_data, split_pattern):
     """
     split raw data
@@ -183,31 +310,100 @@ def prepare_dataset(raw_data_path, output_path, raw_data_type='train_log'):
     :param raw_data_type:
     :return:
     """
-    with open(raw_data_path, 'r') as reader:
-        raw_data = reader.read()
     if raw_data_type == 'train_log':
-        # split data
-        split_pattern = "warm_start finished, start RL training ...\n|warm_start starting ...\n"
-        expr_param_str, warm_start_data_str, train_data_str = split_raw_data(raw_data, split_pattern)
-
-        # extract structured data
-        expr_param = json.loads(expr_param_str.replace('Dialog Parameters: ', ''))
-        warm_start_data = extract_warm_start_data(warm_start_data_str)
-        train_data = extract_train_data(train_data_str)
+        data_set = {'expr_param': None, 'warm_start_data': [], 'train_data': []}
+        with open(raw_data_path, 'rb') as reader:
+            for section, record, offset in iter_log_records(reader):
+                if section == 'expr_param':
+                    data_set['expr_param'] = record
+                else:
+                    data_set[section].append(record)
         with open(output_path, 'w') as writer:
-            json.dump(
-                {
-                    'expr_param': expr_param,
-                    'warm_start_data': warm_start_data,
-                    'train_data': train_data
-                },
-                writer,
-                indent=2
-            )
+            json.dump(data_set, writer, indent=2)
     else:
         raise NotImplementedError
 
 
+def prepare_dataset_stream(raw_data_path, output_path, resume=False, flush_every=1000):
+    """
+    Extract data from a training log into a JSON-lines file, one {"section", "data", "offset"} record per line,
+    written as the log is read. The "offset" of a record is the log position right after it, so an interrupted
+    extraction (or a log still being written) can be resumed where the last written record ends.
+    :param raw_data_path:
+    :param output_path: JSON-lines file, conventionally ending with .jsonl
+    :param resume: continue an existing output_path instead of overwriting it
+    :param flush_every: number of records written between two flushes
+    :return: the log offset the extraction stopped at
+    """
+    offset, section, mode = 0, 'train_data', 'w'
+    if resume and os.path.exists(output_path):
+        last_record = read_last_record(output_path)
+        if last_record:
+            offset = last_record['offset']
+            if last_record['section'] != 'expr_param':
+                section = last_record['section']
+        mode = 'a'
+
+    with open(raw_data_path, 'rb') as reader, open(output_path, mode) as writer:
+        reader.seek(offset)
+        for ind, (record_section, record, offset) in enumerate(iter_log_records(reader, section), 1):
+            writer.write(json.dumps({'section': record_section, 'data': record, 'offset': offset}) + '\n')
+            if ind % flush_every == 0:
+                writer.flush()
+                logging.info('{0} records extracted, {1} bytes of log read'.format(ind, offset))
+    return offset
+
+
+def iter_trace_dialogues(trace_path):
+    """
+    Rebuild the dialogues of a trace written by the TraceWriter of a DialogManager, without any log parsing
+    :param trace_path:
+    :return: generator of (section, dialogue), in the format of iter_log_records, in the order the dialogues ended.
+        Memory use is bounded by the number of dialogues played at the same time.
+    """
+    open_dialogues = {}
+    for record in iter_trace_records(trace_path):
+        if record['type'] == 'episode':
+            open_dialogues[record['episode']] = (record['section'], {'user_goal': record['user_goal'], 'turns': []})
+        elif record['type'] == 'turn':
+            turns = open_dialogues[record['episode']][1]['turns']
+            turns.append({
+                'turn_id': len(turns),
+                'speaker': record['speaker'],
+                'diaact': record['diaact'],
+                'inform_slots': record['inform_slots'],
+                'request_slots': record['request_slots'],
+                'utterance': record['utterance']
+            })
+        elif record['type'] == 'outcome':
+            section, dialogue = open_dialogues.pop(record['episode'])
+            dialogue['success'] = record['success']
+            yield section, dialogue
+
+
+def iter_extracted_dialogues(dataset_path):
+    """
+    Iterate over the dialogues extracted by prepare_dataset (json) or prepare_dataset_stream (.jsonl),
+    or directly over the dialogues of a trace file
+    :param dataset_path:
+    :return: generator of dialogues, warm start dialogues first
+    """
+    if is_trace_file(dataset_path):
+        for section, dialogue in iter_trace_dialogues(dataset_path):
+            yield dialogue
+    elif dataset_path.endswith('.jsonl'):
+        with open(dataset_path, 'r') as reader:
+            for line in reader:
+                record = json.loads(line)
+                if record['section'] != 'expr_param':
+                    yield record['data']
+    else:
+        with open(dataset_path, 'r') as reader:
+            data_set = json.load(reader)
+        for dialogue in data_set['warm_start_data'] + data_set['train_data']:
+            yield dialogue
+
+
 def create_one_hot_v(selected_set, reference):
     """
 
@@ -260,7 +456,7 @@ def create_3state_v(active_set, negative_set, reference):
 def update_state_dict_vector(user_goal, state_v_component, state_dict, last_sys_turn, user_inform_slot2id, user_request_slot2id,
                              sys_inform_slot2id, sys_request_slot2id, diaact2id, dialog_status):
     state_v = []
-    new_state_dict = copy.deepcopy(state_dict)
+    new_state_dict = dict(state_dict)  # vectors are replaced, never modified in place
     if not last_sys_turn:  # for first turn
         pass
     else:
@@ -289,7 +485,9 @@ def update_state_dict_vector(user_goal, state_v_component, state_dict, last_sys_
 
 
 def update_state_dict_slots(current_speaker, turn, user_goal, old_state_dict):
-    state_dict = copy.deepcopy(old_state_dict)
+    state_dict = dict(old_state_dict)
+    for slots_name in ['history_slots', 'rest_slots', 'consistent_slots', 'inconsistent_slots']:  # updated in place
+        state_dict[slots_name] = list(old_state_dict[slots_name])
     # print('====== state dict BEFORE update =======', state_dict)
     if current_speaker == 'sys':
         for slot, value in turn['inform_slots'].items():
@@ -411,7 +609,8 @@ def cook_one_dialogue(dialogue_item, user_inform_slot2id, user_request_slot2id,
             turn_ids.append(ind)
 
 
-            logging.debug("DEBUG one turn:state_dict:{},\n turn:{},\n last_sys_turn:{}\n state:{}\n label:{}\n ".format(state_dict, turn, last_sys_turn, state_v, label))
+            if DEBUG:
+                logging.debug("DEBUG one turn:state_dict:{},\n turn:{},\n last_sys_turn:{}\n state:{}\n label:{}\n ".format(state_dict, turn, last_sys_turn, state_v, label))
             for slot in turn['inform_slots']:
                 if slot not in state_dict['history_slots']:
                     state_dict['history_slots'].append(slot)
@@ -426,15 +625,73 @@ def lst2dict(lst):
     return item2id, id2item
 
 
+def cook_dialogue_chunk(task):
+    """
+    Cook the successful dialogues of a chunk, in a cook_dataset worker process or in the main process
+    :param task: (dialogues, slot2id_dicts), slot2id_dicts being the id arguments of cook_one_dialogue
+    :return: samples, labels, turn_ids of the chunk in dialogue order, and the number of dialogues in the chunk
+    """
+    dialogues, slot2id_dicts = task
+    chunk_samples, chunk_labels, chunk_turn_ids = [], [], []
+    for dialog_item in dialogues:
+        if dialog_item['success']:  # Only use successful sample now
+            samples, labels, turn_ids = cook_one_dialogue(dialog_item, *slot2id_dicts)
+            chunk_samples.extend(samples)
+            chunk_labels.extend(labels)
+            chunk_turn_ids.extend(turn_ids)
+    return chunk_samples, chunk_labels, chunk_turn_ids, len(dialogues)
+
+
+def iter_chunks(items, chunk_size):
+    items = iter(items)
+    chunk = list(itertools.islice(items, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(items, chunk_size))
+
+
 def dump_data(data_item, source_data_path, output_dir, data_mark):
     soure_data_name = '.'.join(os.path.basename(source_data_path).split('.')[:-1])
     with open(os.path.join(output_dir, soure_data_name + '.' + data_mark + '.json'), 'w') as writer:
         json.dump(data_item, writer, indent=2)
 
 
-def cook_dataset(target_dataset_path, output_dir, split_rate, dump_processed_data=False):
+def dump_npy_data(samples, labels, turn_ids, source_data_path, output_dir, data_mark):
+    """
+    Dump one cooked split as int8 .npy arrays: <name>.<data_mark>.state.npy (samples x state size),
+    .label.npy (samples x label size), .turn_id.npy and .offsets.npy, the first sample of each dialogue.
+    """
+    soure_data_name = '.'.join(os.path.basename(source_data_path).split('.')[:-1])
+    prefix = os.path.join(output_dir, soure_data_name + '.' + data_mark)
+    turn_ids = np.asarray(turn_ids, dtype=np.int32)
+    offsets = np.flatnonzero(np.diff(turn_ids) <= 0) + 1  # turn id restarts with each dialogue
+    np.save(prefix + '.state.npy', np.asarray(samples, dtype=np.int8))
+    np.save(prefix + '.label.npy', np.asarray(labels, dtype=np.int8))
+    np.save(prefix + '.turn_id.npy', turn_ids)
+    np.save(prefix + '.offsets.npy', np.concatenate([[0], offsets]).astype(np.int64) if len(turn_ids) else offsets)
+
+
+def load_cooked_data(data_path):
+    """
+    Load one split dumped by cook_dataset
+    :param data_path: the .json file of the split, or the <name>.<data_mark> prefix of its .npy files
+    :return: samples, labels, turn_ids; for .npy files, read-only memory mapped arrays, their rows are loaded on access
+    """
+    if data_path.endswith('.json'):
+        with open(data_path, 'r') as reader:
+            return zip(*json.load(reader))
+    return (np.load(data_path + '.state.npy', mmap_mode='r'),
+            np.load(data_path + '.label.npy', mmap_mode='r'),
+            np.load(data_path + '.turn_id.npy', mmap_mode='r'))
+
+
+def cook_dataset(target_dataset_path, output_dir, split_rate, dump_processed_data=False, workers=1, chunk_size=100,
+                 data_format='json'):
     """
     Given split dataset as a list, cook the data set into vector representation.
+    :param workers: number of processes cooking chunks of dialogues, the samples keep the dialogue order whatever the number
+    :param chunk_size: number of dialogues per chunk
+    :param data_format: format of the dumped splits, 'json' or 'npy' (see dump_npy_data), the dict is always json
     :return:
     """
     if not os.path.isdir(output_dir):
@@ -462,26 +719,31 @@ def cook_dataset(target_dataset_path, output_dir, split_rate, dump_processed_dat
     all_sample = []
     all_label = []
     all_turn_id = []
-    with open(target_dataset_path, 'r') as reader:
-        data_set = json.load(reader)
-    all_data = data_set['warm_start_data'] + data_set['train_data']
+    all_data = iter_extracted_dialogues(target_dataset_path)
     if DEBUG:
-        all_data = all_data[:1000]
-    for ind, dialog_item in enumerate(all_data):
-        if dialog_item['success']:  # Only use successful sample now
-            samples, labels, turn_ids = cook_one_dialogue(
-                dialog_item,
-                user_inform_slot2id,
-                user_request_slot2id,
-                sys_inform_slot2id,
-                sys_request_slot2id,
-                diaact2id
-            )
-            all_sample.extend(samples)
-            all_label.extend(labels)
-            all_turn_id.extend(turn_ids)
-        if ind % 100 == 0:
-            logging.info("{0} dialogues processed".format(ind))
+        all_data = itertools.islice(all_data, 1000)
+    slot2id_dicts = (user_inform_slot2id, user_request_slot2id, sys_inform_slot2id, sys_request_slot2id, diaact2id)
+    tasks = ((chunk, slot2id_dicts) for chunk in iter_chunks(all_data, chunk_size))
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        cooked_chunks = pool.imap(cook_dialogue_chunk, tasks)  # results come back in chunk order
+    else:
+        cooked_chunks = itertools.imap(cook_dialogue_chunk, tasks)
+
+    dialogue_num = 0
+    start_time = time.time()
+    for samples, labels, turn_ids, chunk_dialogue_num in cooked_chunks:
+        all_sample.extend(samples)
+        all_label.extend(labels)
+        all_turn_id.extend(turn_ids)
+        dialogue_num += chunk_dialogue_num
+        elapsed_time = max(time.time() - start_time, 1e-6)
+        logging.info("{0} dialogues processed, {1} samples, {2:.1f} dialogues/s".format(
+            dialogue_num, len(all_sample), dialogue_num / elapsed_time))
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     train_end_idx = int(len(all_sample) * split_rate[0])
     dev_end_idx = int(len(all_sample) *split_rate[1]) + train_end_idx
@@ -516,7 +778,12 @@ def cook_dataset(target_dataset_path, output_dir, split_rate, dump_processed_dat
     }
 
     # dump data
-    if dump_processed_data:
+    if dump_processed_data and data_format == 'npy':
+        dump_npy_data(train_data, train_label, train_turn_id, target_dataset_path, output_dir, 'train')
+        dump_npy_data(dev_data, dev_label, dev_turn_id, target_dataset_path, output_dir, 'dev')
+        dump_npy_data(test_data, test_label, test_turn_id, target_dataset_path, output_dir, 'test')
+        dump_data(all_dict, target_dataset_path, output_dir, 'dict')
+    elif dump_processed_data:
         dump_data(zip(train_data, train_label, train_turn_id), target_dataset_path, output_dir, 'train')
         dump_data(zip(dev_data, dev_label, dev_turn_id), target_dataset_path, output_dir, 'dev')
         dump_data(zip(test_data, test_label, test_turn_id), target_dataset_path, output_dir, 'test')
@@ -526,6 +793,12 @@ def cook_dataset(target_dataset_path, output_dir, split_rate, dump_processed_dat
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_format', choices=['json', 'npy'], default='json',
+                        help="format of the cooked splits: 'json', or 'npy' (int8 arrays, memory mapped by load_cooked_data; "
+                             "pass the split path prefix, without .state.npy, as --train_path etc. of run_action_generation.py)")
+    args = parser.parse_args()
+
     # extract data from raw log data
     # prepare_dataset(raw_data_path=LOG_PATH, output_path=OUTPUT_PATH)
 
@@ -534,5 +807,7 @@ if __name__ == '__main__':
         target_dataset_path=EXTRACTED_LOG_DATA_PATH,
         output_dir=EXPR_DIR,
         split_rate=[0.8, 0.1, 0.1],
-        dump_processed_data=True
+        dump_processed_data=True,
+        workers=multiprocessing.cpu_count(),
+        data_format=args.data_format
     )
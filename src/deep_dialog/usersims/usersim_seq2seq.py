@@ -91,6 +91,7 @@ class Seq2SeqUserSimulator(RuleSimulator):
             self.classifier.load_state_dict(saved_model['state_dict'])
         with open(dict_path, 'r') as reader:
             self.full_dict = json.load(reader)
+        self.action_decoder = ActionDecoder(self.full_dict, self.id2token)  # decoding tables of the predictions
         self.state_dict = {}
         self.state_v_history = []
 
@@ -184,82 +185,92 @@ class Seq2SeqUserSimulator(RuleSimulator):
         return s_r
 
     def predict_action(self, state_representation):
+        return self.predict_action_batch([state_representation])[0]
+
+    def predict_action_batch(self, state_representations):
+        """ Predict the actions for the state representations of several dialogs with one forward pass """
         self.classifier.eval()
-        output = self.classifier.forward(state_representation)[0]  # batch size is 1
-        output = gen2vector(output, self.id2token, self.full_dict)
-        pred_action = vector2action(output, self.full_dict)
-        return pred_action
+        outputs = self.classifier.forward(torch.cat(state_representations, 0))
+        return self.action_decoder.decode(outputs)
 
     def next(self, system_action, rule_style=False):
         if rule_style:
             return self.rule_next(system_action)
         else:
-            self.state['turn'] += 2
-            self.detect_finish(system_action)
+            state_representation = self.observe(system_action)
+            return self.respond(self.predict_action(state_representation))
 
-            sys_act = system_action['diaact']
+    def observe(self, system_action):
+        """ Track the system action, return the state representation the user action is predicted from """
+        self.state['turn'] += 2
+        self.detect_finish(system_action)
 
-            if (self.max_turn > 0 and self.state['turn'] > self.max_turn):
-                self.dialog_status = dialog_config.FAILED_DIALOG
-                self.episode_over = True
-            else:
-                self.state['history_slots'].update(self.state['inform_slots'])
-                self.state['inform_slots'].clear()
-
-            last_sys_turn = {
-                "request_slots": system_action['request_slots'],
-                "diaact": system_action['diaact'],
-                "inform_slots": system_action['inform_slots'],
-                "turn_id": self.state['turn'] - 1,
-                "speaker": "sys",
-                "utterance": '',
-            }
-
-            # update state_dict: rest slot, consistency & inconsistency slot
-            self.state_dict = update_state_dict_slots(
-                current_speaker='sys', turn=last_sys_turn, user_goal=self.goal, old_state_dict=self.state_dict
-            )
-            # update state_dict: vector
-            state_v, self.state_dict = update_state_dict_vector(
-                user_goal=self.goal,
-                state_v_component=self.state_v_component,
-                state_dict=self.state_dict,
-                last_sys_turn=last_sys_turn,
-                user_inform_slot2id=self.full_dict['user_inform_slot2id'],
-                user_request_slot2id=self.full_dict['user_request_slot2id'],
-                sys_inform_slot2id=self.full_dict['sys_inform_slot2id'],
-                sys_request_slot2id=self.full_dict['sys_request_slot2id'],
-                diaact2id=self.full_dict['diaact2id'],
-                dialog_status=0,
-            )
-            self.state_v_history = [state_v] + self.state_v_history  # add current state to the front
-            state_representation = self.get_state_representation()
-            pred_action = self.predict_action(state_representation)
-            self.fill_slot_value(pred_action)
-            response_action = {}
-            response_action['diaact'] = self.state['diaact']
-            response_action['inform_slots'] = self.state['inform_slots']
-            response_action['request_slots'] = self.state['request_slots']
-            response_action['turn'] = self.state['turn']
-            response_action['nl'] = ""
+        sys_act = system_action['diaact']
 
-            current_user_turn = {
-                "request_slots": response_action['request_slots'],
-                "diaact": response_action['diaact'],
-                "inform_slots": response_action['inform_slots'],
-                "turn_id": self.state['turn'],
-                "speaker": "usr",
-                "utterance": '',
-            }
-
-            # update state_dict: informed slots
-            self.state_dict = update_state_dict_slots(
-                current_speaker='usr', turn=current_user_turn, user_goal=self.goal, old_state_dict=self.state_dict
-            )
+        if (self.max_turn > 0 and self.state['turn'] > self.max_turn):
+            self.dialog_status = dialog_config.FAILED_DIALOG
+            self.episode_over = True
+        else:
+            self.state['history_slots'].update(self.state['inform_slots'])
+            self.state['inform_slots'].clear()
 
-            # add NL to dia_act
-            self.add_nl_to_action(response_action)
-            return response_action, self.episode_over, self.dialog_status
+        last_sys_turn = {
+            "request_slots": system_action['request_slots'],
+            "diaact": system_action['diaact'],
+            "inform_slots": system_action['inform_slots'],
+            "turn_id": self.state['turn'] - 1,
+            "speaker": "sys",
+            "utterance": '',
+        }
+
+        # update state_dict: rest slot, consistency & inconsistency slot
+        self.state_dict = update_state_dict_slots(
+            current_speaker='sys', turn=last_sys_turn, user_goal=self.goal, old_state_dict=self.state_dict
+        )
+        # update state_dict: vector
+        state_v, self.state_dict = update_state_dict_vector(
+            user_goal=self.goal,
+            state_v_component=self.state_v_component,
+            state_dict=self.state_dict,
+            last_sys_turn=last_sys_turn,
+            user_inform_slot2id=self.full_dict['user_inform_slot2id'],
+            user_request_slot2id=self.full_dict['user_request_slot2id'],
+            sys_inform_slot2id=self.full_dict['sys_inform_slot2id'],
+            sys_request_slot2id=self.full_dict['sys_request_slot2id'],
+            diaact2id=self.full_dict['diaact2id'],
+            dialog_status=0,
+        )
+        self.state_v_history = [state_v] + self.state_v_history  # add current state to the front
+        state_representation = self.get_state_representation()
+        return state_representation
+
+    def respond(self, pred_action):
+        """ Build the user response (response_action, episode_over, dialog_status) from the predicted action """
+        self.fill_slot_value(pred_action)
+        response_action = {}
+        response_action['diaact'] = self.state['diaact']
+        response_action['inform_slots'] = self.state['inform_slots']
+        response_action['request_slots'] = self.state['request_slots']
+        response_action['turn'] = self.state['turn']
+        response_action['nl'] = ""
+
+        current_user_turn = {
+            "request_slots": response_action['request_slots'],
+            "diaact": response_action['diaact'],
+            "inform_slots": response_action['inform_slots'],
+            "turn_id": self.state['turn'],
+            "speaker": "usr",
+            "utterance": '',
+        }
+
+        # update state_dict: informed slots
+        self.state_dict = update_state_dict_slots(
+            current_speaker='usr', turn=current_user_turn, user_goal=self.goal, old_state_dict=self.state_dict
+        )
+
+        # add NL to dia_act
+        self.add_nl_to_action(response_action)
+        return response_action, self.episode_over, self.dialog_status
 
     def rule_next(self, system_action):
         """ Generate next User Action based on last System Action """
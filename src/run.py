@@ -27,12 +27,14 @@ RL: python run.py --agt 9 --usr 1 --max_turn 40 --movie_kb_path .\deep_dialog\da
 """
 
 
-import argparse, json, copy, os
+import argparse, json, os
+import multiprocessing
 import cPickle as pickle
 
-from deep_dialog.dialog_system import DialogManager, text_to_dict
+from deep_dialog.dialog_system import DialogManager, BatchedDialogManager, open_trace_writer, TraceRecorder, text_to_dict
 from deep_dialog.agents import AgentCmd, InformAgent, RequestAllAgent, RandomAgent, EchoAgent, RequestBasicsAgent, AgentDQN
-from deep_dialog.usersims import RuleSimulator
+from deep_dialog.qlearning import CheckpointWriter
+from deep_dialog.usersims import RuleSimulator, UserSimulatorInferenceServer
 from deep_dialog.usersims.usersim_supervise import SuperviseUserSimulator
 from deep_dialog.usersims.usersim_seq2seq import Seq2SeqUserSimulator
 from deep_dialog.usersims.usersim_seq2seq_att import Seq2SeqAttUserSimulator
@@ -45,6 +47,7 @@ from deep_dialog.nlu import nlu
 from deep_dialog.nlg import nlg
 
 import random
+import numpy as np
 import torch
 """ 
 Launch a dialog simulation per the command line arguments
@@ -85,21 +88,33 @@ if __name__ == "__main__":
     parser.add_argument('--run_mode', dest='run_mode', type=int, default=0, help='run_mode: 0 for default NL; 1 for dia_act; 2 for both')
     parser.add_argument('--auto_suggest', dest='auto_suggest', type=int, default=0, help='0 for no auto_suggest; 1 for auto_suggest')
     parser.add_argument('--cmd_input_mode', dest='cmd_input_mode', type=int, default=0, help='run_mode: 0 for NL; 1 for dia_act')
+    parser.add_argument('--trace_path', dest='trace_path', type=str, default=None, help='record every dialog (those of the simulation workers included) to this trace file (JSON lines for a .jsonl path, binary otherwise), readable by prepare_data; use with run_mode 3 to drop the printed log')
+    parser.add_argument('--trace_flush_every', dest='trace_flush_every', type=int, default=1000, help='the number of trace records buffered between two writes')
     
     # RL agent parameters
     parser.add_argument('--experience_replay_pool_size', dest='experience_replay_pool_size', type=int, default=1000, help='the size for experience replay')
+    parser.add_argument('--experience_replay_pool_max_size', dest='experience_replay_pool_max_size', type=int, default=None, help='the hard capacity of experience replay, oldest transitions are evicted beyond it; None for no limit')
     parser.add_argument('--dqn_hidden_size', dest='dqn_hidden_size', type=int, default=60, help='the hidden size for DQN')
     parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='batch size')
     parser.add_argument('--gamma', dest='gamma', type=float, default=0.9, help='gamma for DQN')
     parser.add_argument('--predict_mode', dest='predict_mode', type=bool, default=False, help='predict model for DQN')
     parser.add_argument('--simulation_epoch_size', dest='simulation_epoch_size', type=int, default=50, help='the size of validation set')
+    parser.add_argument('--simulation_workers', dest='simulation_workers', type=int, default=0, help='0: play simulation epochs as is; 1: with a deterministic seed per episode; >1: seeded and split across that many worker processes (same results as 1), forked at the first simulation epoch: the DQN weights, epsilon and warm_start are sent with every epoch, any other agent or user simulator change made later is not seen by the workers')
+    parser.add_argument('--simulation_batch_size', dest='simulation_batch_size', type=int, default=1, help='the number of simulation dialogs stepped together, with one batched agent decision per step (DQN agent, simulation_workers 0)')
     parser.add_argument('--warm_start', dest='warm_start', type=int, default=1, help='0: no warm start; 1: warm start for training')
     parser.add_argument('--warm_start_epochs', dest='warm_start_epochs', type=int, default=100, help='the number of epochs for warm start')
     
     parser.add_argument('--trained_model_path', dest='trained_model_path', type=str, default=None, help='the path for trained model')
     parser.add_argument('-o', '--write_model_dir', dest='write_model_dir', type=str, default='./deep_dialog/checkpoints/', help='write model to disk') 
     parser.add_argument('--save_check_point', dest='save_check_point', type=int, default=10, help='number of epochs for saving model')
+    parser.add_argument('--checkpoint_queue_size', dest='checkpoint_queue_size', type=int, default=4, help='the number of checkpoint files queued for the background writer; 0 writes them synchronously')
+    parser.add_argument('--checkpoint_format', dest='checkpoint_format', type=str, default='p', choices=['p', 'model'], help="'p': pickled checkpoints; 'model': model files, memory-mapped when loaded (see deep_dialog/model_file.py)")
+    parser.add_argument('--keep_checkpoints', dest='keep_checkpoints', type=int, default=0, help='the number of newest model checkpoints kept on disk; 0 keeps all')
      
+    parser.add_argument('--kb_cache_max_entries', dest='kb_cache_max_entries', type=int, default=10000, help='the max number of cached KB queries (LRU eviction); 0 for no limit')
+    parser.add_argument('--kb_cache_max_bytes', dest='kb_cache_max_bytes', type=int, default=0, help='the max estimated bytes of cached KB results (LRU eviction); 0 for no limit')
+    parser.add_argument('--kb_cache_normalize_keys', dest='kb_cache_normalize_keys', type=int, default=1, help='1: key the KB cache on lowercased values of constraining slots; 0: key on the raw inform slots')
+
     parser.add_argument('--success_rate_threshold', dest='success_rate_threshold', type=float, default=0.3, help='the threshold for success rate')
     
     parser.add_argument('--split_fold', dest='split_fold', default=5, type=int, help='the number of folders to split the user goal')
@@ -116,6 +131,7 @@ if __name__ == "__main__":
     ''' Set GPU and seed'''
     torch.manual_seed(args.seed)
     random.seed(args.seed)
+    np.random.seed(args.seed)
     if args.gpu >= 0:
         print(args.gpu)
         torch.cuda.set_device(args.gpu)
@@ -173,6 +189,7 @@ agent_params['agent_run_mode'] = params['run_mode']
 agent_params['agent_act_level'] = params['act_level']
 
 agent_params['experience_replay_pool_size'] = params['experience_replay_pool_size']
+agent_params['experience_replay_pool_max_size'] = params['experience_replay_pool_max_size']
 agent_params['dqn_hidden_size'] = params['dqn_hidden_size']
 agent_params['batch_size'] = params['batch_size']
 agent_params['gamma'] = params['gamma']
@@ -217,24 +234,28 @@ usersim_params['learning_phase'] = params['learning_phase']
 usersim_params['warm_start'] = params['warm_start']
 usersim_params['rule_first_turn'] = params['rule_first_turn']
 
-if usr == 0:# real user
-    user_sim = RealUser(movie_dictionary, act_set, slot_set, goal_set, usersim_params)
-elif usr == 1: 
-    user_sim = RuleSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params)
-elif usr == 2:
-    user_sim = SuperviseUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
-elif usr == 3:
-    user_sim = Seq2SeqUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
-elif usr == 4:
-    user_sim = Seq2SeqAttUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
-elif usr == 5:
-    user_sim = State2SeqUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
+def create_user_simulator():
+    if usr == 0:# real user
+        user_sim = RealUser(movie_dictionary, act_set, slot_set, goal_set, usersim_params)
+    elif usr == 1: 
+        user_sim = RuleSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params)
+    elif usr == 2:
+        user_sim = SuperviseUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
+    elif usr == 3:
+        user_sim = Seq2SeqUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
+    elif usr == 4:
+        user_sim = Seq2SeqAttUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
+    elif usr == 5:
+        user_sim = State2SeqUserSimulator(movie_dictionary, act_set, slot_set, goal_set, usersim_params, use_cuda=USE_CUDA, rule_first_turn=params['rule_first_turn'])
+    
+    ################################################################################
+    #    Add your user simulator here
+    ################################################################################
+    else:
+        user_sim = None
+    return user_sim
 
-################################################################################
-#    Add your user simulator here
-################################################################################
-else:
-    pass
+user_sim = create_user_simulator()
 
 
 ################################################################################
@@ -264,7 +285,34 @@ user_sim.set_nlu_model(nlu_model)
 ################################################################################
 # Dialog Manager
 ################################################################################
-dialog_manager = DialogManager(agent, user_sim, act_set, slot_set, movie_kb)
+kb_params = {}
+kb_params['kb_cache_max_entries'] = params['kb_cache_max_entries'] or None
+kb_params['kb_cache_max_bytes'] = params['kb_cache_max_bytes'] or None
+kb_params['kb_cache_normalize_keys'] = params['kb_cache_normalize_keys'] == 1
+
+trace_writer = None
+if params['trace_path'] is not None:
+    trace_writer = open_trace_writer(params['trace_path'], params['trace_flush_every'])
+
+dialog_manager = DialogManager(agent, user_sim, act_set, slot_set, movie_kb, kb_params, trace_writer)
+
+simulation_batch_size = params['simulation_batch_size']
+batched_dialog_manager = None
+
+def get_batched_dialog_manager():
+    """ The BatchedDialogManager of the simulation epochs: user_sim plus simulation_batch_size-1 extra simulators """
+    
+    global batched_dialog_manager
+    if batched_dialog_manager is None:
+        users = [user_sim]
+        for i in xrange(simulation_batch_size - 1):
+            user = create_user_simulator()
+            user.set_nlg_model(nlg_model)
+            user.set_nlu_model(nlu_model)
+            if hasattr(user_sim, 'classifier'): user.classifier = user_sim.classifier # one model, batched by the inference server
+            users.append(user)
+        batched_dialog_manager = BatchedDialogManager(agent, users, act_set, slot_set, movie_kb, kb_params, UserSimulatorInferenceServer(simulation_batch_size), trace_writer)
+    return batched_dialog_manager
     
     
 ################################################################################
@@ -284,7 +332,7 @@ save_check_point = params['save_check_point']
 """ Best Model and Performance Records """
 best_model = {}
 best_res = {'success_rate': 0, 'ave_reward':float('-inf'), 'ave_turns': float('inf'), 'epoch':0}
-best_model['model'] = copy.deepcopy(agent)
+best_model['model'] = agent.dqn.snapshot() if agt == 9 else None # the DQN weights of the best model, see DQN.snapshot
 best_res['success_rate'] = 0
 
 performance_records = {}
@@ -292,32 +340,100 @@ performance_records['success_rate'] = {}
 performance_records['ave_turns'] = {}
 performance_records['ave_reward'] = {}
 
+checkpoint_writer = CheckpointWriter(params['checkpoint_queue_size'], params['keep_checkpoints'])
+
 
 """ Save model """
-def save_model(path, agt, usr, success_rate, agent, best_epoch, cur_epoch, hidden_size, seed, epsilon, rule_first):
-    filename = 'agt_{}_usr_{}_b-e{}_c-e{}_s-r{:.2f}_h-s{}_sd{}_epsl{}_rft{}.p'.format(agt, usr, best_epoch, cur_epoch, success_rate, hidden_size, seed, epsilon, rule_first)
+def save_model(path, agt, usr, success_rate, model, best_epoch, cur_epoch, hidden_size, seed, epsilon, rule_first):
+    filename = 'agt_{}_usr_{}_b-e{}_c-e{}_s-r{:.2f}_h-s{}_sd{}_epsl{}_rft{}.{}'.format(agt, usr, best_epoch, cur_epoch, success_rate, hidden_size, seed, epsilon, rule_first, params['checkpoint_format'])
     filepath = os.path.join(path, filename)
     checkpoint = {}
-    if agt == 9: checkpoint['model'] = copy.deepcopy(agent.dqn.model)
-    checkpoint['params'] = params
-    try:
-        pickle.dump(checkpoint, open(filepath, "wb"))
-        print 'saved model in %s' % (filepath, )
-    except Exception, e:
-        print 'Error: Writing model fails: %s' % (filepath, )
-        print e
+    if agt == 9: checkpoint['model'] = agent.dqn.snapshot_model(model.copy()) # the best model snapshot is updated in place
+    checkpoint['params'] = dict(params)
+    if params['checkpoint_format'] == 'model':
+        checkpoint_writer.save_model_file(filepath, checkpoint)
+    else:
+        checkpoint_writer.save_pickle(filepath, checkpoint)
 
 """ save performance numbers """
 def save_performance_records(path, agt, usr, success_rate, hidden_size, seed, epsilon, rule_first, records):
     filename = 'agt_{}_usr_{}_s-r{:.2f}_h-s{}_sd{}_epsl{}_rft{}performance_redcords.json'.format(agt, usr, success_rate, hidden_size, seed, epsilon, rule_first)
     # filename = 'agt_{}_usr_{}_performance_records.json'.format(agt, usr)
     filepath = os.path.join(path, filename)
-    try:
-        json.dump(records, open(filepath, "wb"))
-        print 'saved model in %s' % (filepath, )
-    except Exception, e:
-        print 'Error: Writing model fails: %s' % (filepath, )
-        print e
+    checkpoint_writer.save_json(filepath, dict((name, dict(record)) for name, record in records.items()))
+
+""" Seeded (and optionally parallel) simulation: every simulation episode is played under its own deterministic seed """
+simulation_workers = params['simulation_workers']
+simulation_pool = None
+simulation_epoch_index = 0
+simulation_agent_settings = ['epsilon', 'warm_start'] # sent to the workers with each task, as the DQN weights
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def simulation_episode_seed(epoch_index, episode):
+    return (params['seed'] * 1000003 + epoch_index * 10007 + episode) % 2147483647
+
+def play_simulation_episodes(epoch_index, episodes):
+    """ Play the given episodes of a simulation epoch, each under its own seed; return (episode, reward, turns) per episode """
+    
+    episode_stats = []
+    for episode in episodes:
+        seed_everything(simulation_episode_seed(epoch_index, episode))
+        dialog_manager.initialize_episode()
+        episode_over = False
+        episode_reward = 0
+        while(not episode_over):
+            episode_over, reward = dialog_manager.next_turn()
+            episode_reward += reward
+        episode_stats.append((episode, reward, episode_reward, dialog_manager.state_tracker.turn_count))
+    return episode_stats
+
+def simulation_worker_init():
+    torch.set_num_threads(1)
+
+def simulation_worker(task):
+    """ Run in a forked worker process: play a chunk of episodes with the parent's current DQN weights (a snapshot) and agent settings """
+    
+    epoch_index, episodes, dqn_weights, agent_settings = task
+    for name, value in agent_settings.items():
+        setattr(agent, name, value)
+    trace_recorder = TraceRecorder() if trace_writer is not None else None # the records are written by the main process
+    dialog_manager.trace_writer = trace_recorder
+    agent.dqn.load_snapshot(dqn_weights)
+    agent.predict_mode = True
+    agent.experience_replay_pool.clear()
+    episode_stats = play_simulation_episodes(epoch_index, episodes)
+    trace_records = trace_recorder.records if trace_recorder is not None else []
+    return episode_stats, agent.experience_replay_pool.transitions(), trace_records
+
+def seeded_simulation_epoch(simulation_epoch_size):
+    """ Play the simulation epoch with per-episode seeds, in simulation_workers processes when more than 1; transitions and trace records are registered in episode order """
+    
+    global simulation_pool, simulation_epoch_index
+    epoch_index = simulation_epoch_index
+    simulation_epoch_index += 1
+    
+    if simulation_workers > 1:
+        if simulation_pool is None:
+            simulation_pool = multiprocessing.Pool(simulation_workers, initializer=simulation_worker_init)
+        chunk_size = max(1, -(-simulation_epoch_size // (simulation_workers * 4)))
+        agent_settings = dict((name, getattr(agent, name)) for name in simulation_agent_settings)
+        tasks = [(epoch_index, range(start, min(start + chunk_size, simulation_epoch_size)), agent.dqn.weights, agent_settings) for start in xrange(0, simulation_epoch_size, chunk_size)]
+        
+        episode_stats = []
+        for chunk_stats, transitions, trace_records in simulation_pool.map(simulation_worker, tasks):
+            episode_stats.extend(chunk_stats)
+            agent.experience_replay_pool.extend(transitions)
+            if trace_writer is not None: trace_writer.write_records(trace_records)
+    else:
+        episode_stats = play_simulation_episodes(epoch_index, xrange(simulation_epoch_size))
+    
+    # continue the main process from the same random state whatever the number of workers
+    seed_everything(simulation_episode_seed(epoch_index, simulation_epoch_size))
+    return episode_stats
 
 """ Run N simulation Dialogues """
 def simulation_epoch(simulation_epoch_size):
@@ -326,18 +442,35 @@ def simulation_epoch(simulation_epoch_size):
     cumulative_turns = 0
     
     res = {}
-    for episode in xrange(simulation_epoch_size):
-        dialog_manager.initialize_episode()
-        episode_over = False
-        while(not episode_over):
-            episode_over, reward = dialog_manager.next_turn()
-            cumulative_reward += reward
-            if episode_over:
-                if reward > 0: 
-                    successes += 1
-                    print ("simulation episode %s: Success" % (episode))
-                else: print ("simulation episode %s: Fail" % (episode))
-                cumulative_turns += dialog_manager.state_tracker.turn_count
+    if simulation_workers > 0:
+        for episode, reward, episode_reward, turns in seeded_simulation_epoch(simulation_epoch_size):
+            cumulative_reward += episode_reward
+            if reward > 0: 
+                successes += 1
+                print ("simulation episode %s: Success" % (episode))
+            else: print ("simulation episode %s: Fail" % (episode))
+            cumulative_turns += turns
+    elif simulation_batch_size > 1 and agt == 9:
+        for episode, (reward, episode_reward, turns) in enumerate(get_batched_dialog_manager().run_episodes(simulation_epoch_size)):
+            cumulative_reward += episode_reward
+            if reward > 0: 
+                successes += 1
+                print ("simulation episode %s: Success" % (episode))
+            else: print ("simulation episode %s: Fail" % (episode))
+            cumulative_turns += turns
+    else:
+        for episode in xrange(simulation_epoch_size):
+            dialog_manager.initialize_episode()
+            episode_over = False
+            while(not episode_over):
+                episode_over, reward = dialog_manager.next_turn()
+                cumulative_reward += reward
+                if episode_over:
+                    if reward > 0: 
+                        successes += 1
+                        print ("simulation episode %s: Success" % (episode))
+                    else: print ("simulation episode %s: Fail" % (episode))
+                    cumulative_turns += dialog_manager.state_tracker.turn_count
     
     res['success_rate'] = float(successes)/simulation_epoch_size
     res['ave_reward'] = float(cumulative_reward)/simulation_epoch_size
@@ -387,7 +520,9 @@ def run_episodes(count, status):
     
     if agt == 9 and params['trained_model_path'] == None and warm_start == 1:
         print ('warm_start starting ...')
+        if trace_writer is not None: trace_writer.start_section('warm_start_data')
         warm_start_simulation()
+        if trace_writer is not None: trace_writer.start_section('train_data')
         print ('warm_start finished, start RL training ...')
     
     for episode in xrange(count):
@@ -418,23 +553,23 @@ def run_episodes(count, status):
             
             if simulation_res['success_rate'] >= best_res['success_rate']:
                 if simulation_res['success_rate'] >= success_rate_threshold: # threshold = 0.30
-                    agent.experience_replay_pool = [] 
+                    agent.experience_replay_pool.clear()
                     simulation_epoch(simulation_epoch_size)
                 
             if simulation_res['success_rate'] > best_res['success_rate']:
-                best_model['model'] = copy.deepcopy(agent)
+                best_model['model'] = agent.dqn.snapshot(best_model['model'])
                 best_res['success_rate'] = simulation_res['success_rate']
                 best_res['ave_reward'] = simulation_res['ave_reward']
                 best_res['ave_turns'] = simulation_res['ave_turns']
                 best_res['epoch'] = episode
                 
-            agent.clone_dqn = copy.deepcopy(agent.dqn)
+            agent.update_clone_dqn()
             agent.train(batch_size, 1)
             agent.predict_mode = False
             
             print ("Simulation success rate %s, Ave reward %s, Ave turns %s, Best success rate %s" % (performance_records['success_rate'][episode], performance_records['ave_reward'][episode], performance_records['ave_turns'][episode], best_res['success_rate']))
             if episode % save_check_point == 0 and params['trained_model_path'] == None: # save the model every 10 episodes
-                save_model(path=params['write_model_dir'], agt=agt, usr=usr, success_rate=best_res['success_rate'], agent=best_model['model'], best_epoch=best_res['epoch'], cur_epoch=episode, hidden_size=params['dqn_hidden_size'], seed=params['seed'], epsilon=params['epsilon'], rule_first=params['rule_first_turn'])
+                save_model(path=params['write_model_dir'], agt=agt, usr=usr, success_rate=best_res['success_rate'], model=best_model['model'], best_epoch=best_res['epoch'], cur_epoch=episode, hidden_size=params['dqn_hidden_size'], seed=params['seed'], epsilon=params['epsilon'], rule_first=params['rule_first_turn'])
                 save_performance_records(path=params['write_model_dir'], agt=agt, usr=usr, success_rate=best_res['success_rate'], hidden_size=params['dqn_hidden_size'], seed=params['seed'], epsilon=params['epsilon'], rule_first=params['rule_first_turn'], records=performance_records)
         
         print("Progress: %s / %s, Success rate: %s / %s Avg reward: %.2f Avg turns: %.2f" % (episode+1, count, successes, episode+1, float(cumulative_reward)/(episode+1), float(cumulative_turns)/(episode+1)))
@@ -443,7 +578,14 @@ def run_episodes(count, status):
     status['count'] += count
     
     if agt == 9 and params['trained_model_path'] == None:
-        save_model(path=params['write_model_dir'], agt=agt, usr=usr, success_rate=float(successes)/count, agent=best_model['model'], best_epoch=best_res['epoch'], cur_epoch=count, hidden_size=params['dqn_hidden_size'], seed=params['seed'], epsilon=params['epsilon'], rule_first=params['rule_first_turn'])
+        save_model(path=params['write_model_dir'], agt=agt, usr=usr, success_rate=float(successes)/count, model=best_model['model'], best_epoch=best_res['epoch'], cur_epoch=count, hidden_size=params['dqn_hidden_size'], seed=params['seed'], epsilon=params['epsilon'], rule_first=params['rule_first_turn'])
         save_performance_records(path=params['write_model_dir'], agt=agt, usr=usr, success_rate=float(successes)/count, hidden_size=params['dqn_hidden_size'], seed=params['seed'], epsilon=params['epsilon'], rule_first=params['rule_first_turn'], records=performance_records)
     
 run_episodes(num_episodes, status)
+if simulation_pool is not None:
+    simulation_pool.close()
+    simulation_pool.join()
+if trace_writer is not None:
+    trace_writer.close()
+checkpoint_writer.close()
+print ("KB cache stats: %s" % (json.dumps(dialog_manager.state_tracker.kb_helper.cache_stats())))
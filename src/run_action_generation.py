@@ -59,9 +59,9 @@ def main():
 
 
     # define path
-    cmd.add_argument('--train_path', help='the path to the training file.', default= '{0}TaskOrientedDialogue/data/TC-bot/data/{1}/{1}.train.json'.format(PROJECT_DIR, DATA_MARK))
-    cmd.add_argument('--dev_path', help='the path to the validation file.', default='{0}TaskOrientedDialogue/data/TC-bot/data/{1}/{1}.dev.json'.format(PROJECT_DIR, DATA_MARK))
-    cmd.add_argument('--test_path', help='the path to the testing file.', default='{0}TaskOrientedDialogue/data/TC-bot/data/{1}/{1}.test.json'.format(PROJECT_DIR, DATA_MARK))
+    cmd.add_argument('--train_path', help='the path to the training file (.json), or the path prefix of its .npy files without the .state.npy suffix.', default= '{0}TaskOrientedDialogue/data/TC-bot/data/{1}/{1}.train.json'.format(PROJECT_DIR, DATA_MARK))
+    cmd.add_argument('--dev_path', help='the path to the validation file (.json or .npy prefix).', default='{0}TaskOrientedDialogue/data/TC-bot/data/{1}/{1}.dev.json'.format(PROJECT_DIR, DATA_MARK))
+    cmd.add_argument('--test_path', help='the path to the testing file (.json or .npy prefix).', default='{0}TaskOrientedDialogue/data/TC-bot/data/{1}/{1}.test.json'.format(PROJECT_DIR, DATA_MARK))
     cmd.add_argument('--dict_path', help='the path to the full dict file.', default='{0}TaskOrientedDialogue/data/TC-bot/data/{1}/{1}.dict.json'.format(PROJECT_DIR, DATA_MARK))
     cmd.add_argument("--model", help="path to save model", default='{0}TaskOrientedDialogue/data/TC-bot/data/{1}/'.format(PROJECT_DIR, DATA_MARK))
     cmd.add_argument("--model_name", help="name to save model", default='model.pkl')